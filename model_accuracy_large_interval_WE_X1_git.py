@@ -2,131 +2,2749 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
+import concurrent.futures
+import cProfile
 import datetime
+import json
 import logging
+import multiprocessing
+import os
 import pathlib
-import urllib
-import urllib.parse
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
 import warnings
 from sys import platform
 
+try:
+    import resource
+except ImportError:
+    # нет на windows, пиковая память процесса в отчет не пишется
+    resource = None
+
+# Тяжелые и необязательные библиотеки (pymysql, pyodbc, requests,
+# xlsxwriter, yaml, duckdb) импортируются в функциях, которым они нужны,
+# поэтому импорт модуля (планировщик, ноутбуки) ничего не читает
+# и не подключается к базам, а первый запрос уходит раньше
 import numpy as np
 import pandas as pd
-import pymysql
-import pyodbc
-import requests
-import yaml
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from sklearn.metrics import r2_score
-
-warnings.filterwarnings("ignore")
-
-# количество дней от текущей даты
-# до нужной даты за которое грузить прогнозы моделей и выработку
+
+# начало истории, с которой считается точность при полном пересчете
 today = datetime.date.today()
 someday = datetime.date(2022, 9, 1)
-diff = today - someday
 
-DAYS_COUNT = int(diff.days)
+# база из которой грузить модели (архив или основная на 40 дней)
+WORKING_DB_ARCHIVE = "treid_03.weather_foreca_archive"
+WORKING_DB = "treid_03.weather_foreca"
+
+# Провайдеры прогнозов: название -> id_foreca
+PROVIDERS_DEFAULT = {
+    "cblg": 14,
+    "wpgq": 13,
+    "rp5_1da": 16,
+    "cbr_rp5": 11,
+    "visualcrossing": 18,
+    "openmeteo": 20,
+    "tomorrow_io": 22,
+}
+
+# Ансамбли провайдеров: название в отчете -> столбец прогноза
+ENSEMBLES = {
+    "aver_all": "value_aver",
+    "max_all": "value_max",
+    "blend_all": "value_blend",
+}
+
+
+# Функция моделей, точность которых считается: название в отчете ->
+# столбец прогноза (каждый провайдер из providers и ансамбли)
+
+
+def provider_models(providers):
+    return {
+        **{provider: f"value_{provider}" for provider in providers},
+        **ENSEMBLES,
+    }
+
+
+# Провайдеры и модели запуска, их пересобирает configure из значений
+# по умолчанию (--providers оставляет часть провайдеров)
+PROVIDERS = dict(PROVIDERS_DEFAULT)
+MODELS = provider_models(PROVIDERS)
+
+# Достаточные статистики по группе (дата, гтп, модель и т.п.),
+# из которых считаются метрики
+STATISTICS = [
+    "n",
+    "sum_y",
+    "sum_y2",
+    "sum_p",
+    "sum_p2",
+    "sum_yp",
+    "sum_e2",
+    "sum_abs_e",
+    "ss_tot",
+    "max_y",
+]
+
+# Параметры запуска
+parser = argparse.ArgumentParser(description="Расчет точности моделей.")
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help="полный пересчет с начала истории без учета хранилища статистик",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help=(
+        "очистить кэш прогнозов и загрузить их из баз заново"
+        " (только вместе с --full)"
+    ),
+)
+parser.add_argument(
+    "--date-from",
+    type=datetime.date.fromisoformat,
+    help="частичный пересчет: с даты (ГГГГ-ММ-ДД)",
+)
+parser.add_argument(
+    "--date-to",
+    type=datetime.date.fromisoformat,
+    help="частичный пересчет: по дату включительно (ГГГГ-ММ-ДД)",
+)
+parser.add_argument(
+    "--gtp",
+    nargs="+",
+    help="частичный пересчет: только эти гтп",
+)
+parser.add_argument(
+    "--providers",
+    nargs="+",
+    choices=list(PROVIDERS_DEFAULT),
+    help="частичный пересчет: только эти провайдеры",
+)
+parser.add_argument(
+    "--output-dir",
+    default="",
+    help=(
+        "каталог выгрузок (по умолчанию текущий, при частичном пересчете"
+        " - partial_X1)"
+    ),
+)
+parser.add_argument(
+    "--score-workers",
+    type=int,
+    help="сколько процессов считают статистики (для полного пересчета)",
+)
+parser.add_argument(
+    "--rollups-only",
+    action="store_true",
+    help=(
+        "только пересчитать сводные таблицы точности из хранилища"
+        " статистик (без обращения к базам)"
+    ),
+)
+parser.add_argument(
+    "--watch",
+    action="store_true",
+    help=(
+        "резидентный режим: точность моделей за сегодня по законченным"
+        " часам, обновляется по мере появления факта и отдается по http"
+    ),
+)
+parser.add_argument(
+    "--vintages",
+    action="store_true",
+    help=(
+        "точность прогнозов по срезам времени загрузки (vintage_cutoffs)"
+        " за последние vintage_days дней или за --date-from/--date-to,"
+        " без хранилища статистик и кэша прогнозов"
+    ),
+)
+parser.add_argument(
+    "--trace-memory",
+    action="store_true",
+    help="замерить пиковую память каждого этапа (tracemalloc)",
+)
+parser.add_argument(
+    "--profile",
+    metavar="PATH",
+    help="записать профиль запуска (cProfile) в файл PATH",
+)
+parser.add_argument(
+    "--benchmark-join",
+    action="store_true",
+    help=(
+        "сравнить склейку прогнозов с цепочкой merge на синтетических"
+        " данных и выйти (без обращения к базам)"
+    ),
+)
+parser.add_argument(
+    "--benchmark",
+    action="store_true",
+    help=(
+        "замерить время и память каждого этапа расчета на синтетических"
+        " данных и выйти (без обращения к базам)"
+    ),
+)
+parser.add_argument(
+    "--benchmark-gtp",
+    type=int,
+    nargs="+",
+    default=[100],
+    help="количество гтп в синтетических данных бенчмарка (можно несколько)",
+)
+parser.add_argument(
+    "--benchmark-days",
+    type=int,
+    nargs="+",
+    default=[(today - someday).days],
+    help="количество дней в синтетических данных бенчмарка (можно несколько)",
+)
+parser.add_argument(
+    "--benchmark-missing",
+    type=float,
+    default=0.05,
+    help="доля пропущенных часов факта и прогнозов в бенчмарке",
+)
+parser.add_argument(
+    "--benchmark-repeats",
+    type=int,
+    default=3,
+    help="количество прогонов бенчмарка, берется лучшее время",
+)
+parser.add_argument(
+    "--benchmark-report",
+    help="файл, в который дописываются результаты бенчмарка (json строки)",
+)
+
+# Функция разбора ключей запуска (argv - список ключей, по умолчанию
+# из командной строки)
+# Частичный пересчет для разбора: фильтры по датам, гтп и провайдерам
+# передаются в запросы к MSSQL и MySQL, кэш прогнозов и хранилище
+# статистик только читаются (частичные данные в них не пишутся),
+# сводные таблицы по хранилищу и сводка в telegram не формируются
+
+
+def arguments(argv=None):
+    args = parser.parse_args(argv)
+    partial = args.date_from or args.date_to or args.gtp or args.providers
+    if partial and (args.full or args.refresh or args.rollups_only):
+        parser.error(
+            "--full, --refresh и --rollups-only несовместимы с частичным"
+            " пересчетом"
+        )
+    if args.date_from and args.date_to and args.date_from > args.date_to:
+        parser.error("--date-from позже --date-to")
+    if args.refresh and not args.full:
+        # кэш заполняется с начала окна расчета, без --full очищенный
+        # кэш остался бы без истории до этого окна
+        parser.error("--refresh работает только вместе с --full")
+    if args.vintages and (args.full or args.refresh or args.rollups_only):
+        parser.error(
+            "--full, --refresh и --rollups-only несовместимы с --vintages"
+        )
+    if args.watch and (
+        args.full or args.refresh or args.rollups_only or args.vintages
+    ):
+        parser.error(
+            "--full, --refresh, --rollups-only и --vintages несовместимы"
+            " с --watch"
+        )
+    return args
+
+
+# Максимум строк данных на листе Excel (без строки заголовка)
+EXCEL_MAX_ROWS = 1048575
+# Максимальная длина сообщения telegram
+TELEGRAM_MAX_LENGTH = 4096
+
+# Отчет о запуске (json) по умолчанию пишется рядом с логом
+if platform == "win32":
+    RUN_REPORT_DEFAULT = (
+        f"{pathlib.Path(__file__).parent.absolute()}"
+        "/model_accuracy_run_X1.json"
+    )
+else:
+    RUN_REPORT_DEFAULT = "/var/log/log-execute/model_accuracy_run_X1.json"
+
+# Выгрузки результатов: выгрузка -> формат (parquet, csv, xlsx или off)
+# Почасовая таблица по умолчанию пишется в parquet параллельно с расчетом,
+# итоговые таблицы r2 - в xlsx потоковой записью
+# (настройка outputs меняет форматы поверх OUTPUTS_DEFAULT в configure)
+OUTPUTS_DEFAULT = {
+    "model_predicts": "parquet",
+    "metrics": "parquet",
+    "rollup_week": "parquet",
+    "rollup_month": "parquet",
+    "rollup_hour": "parquet",
+    "rollup_rolling": "parquet",
+    "r2_score": "xlsx",
+    "r2_score_by_gtp": "xlsx",
+    "vintages": "xlsx",
+    "coverage": "parquet",
+}
+OUTPUTS = dict(OUTPUTS_DEFAULT)
+OUTPUT_FILES = {
+    "model_predicts": "model_predicts_dataframe_X1",
+    "metrics": "metrics_dataframe_X1",
+    "rollup_week": "rollup_week_X1",
+    "rollup_month": "rollup_month_X1",
+    "rollup_hour": "rollup_hour_X1",
+    "rollup_rolling": "rollup_rolling_X1",
+    "r2_score": "r2_score_dataframe_X1",
+    "r2_score_by_gtp": "r2_score_dataframe_by_gtp_X1",
+    "vintages": "vintages_X1",
+    "coverage": "coverage_X1",
+}
+
+# ГТП, которые по умолчанию не участвуют в расчете точности
+EXCLUDED_GTP_DEFAULT = [
+    "GVIE0001",
+    "GVIE0012",
+    "GVIE0416",
+    "GVIE0167",
+    "GVIE0264",
+    "GVIE0007",
+    "GVIE0680",
+    "GVIE0987",
+    "GVIE0988",
+    "GVIE0989",
+    "GVIE0991",
+    "GVIE0992",
+    "GVIE0993",
+    "GVIE0994",
+    "GVIE1372",
+]
+
+# Общий раздел
+
+# Функция настройки модуля: ключи запуска (args из arguments) и настройки
+# из settings.yaml рядом со скриптом (или готовый словарь settings)
+# раскладываются по константам модуля, которыми пользуются функции ниже.
+# Вызывается один раз перед run (или перед отдельными функциями расчета
+# из планировщика и ноутбуков), сам импорт модуля ничего не настраивает
+
+
+def configure(args, settings=None):
+    global PARTIAL, PROVIDERS, MODELS, OUTPUT_DIR, OUTPUTS
+    global telegram_settings, sql_settings, pyodbc_settings
+    global postgresql_settings
+    global SCORE_STORE, LOOKBACK_DAYS, SCORE_WORKERS, ENSEMBLE_DAYS
+    global COVERAGE_MIN
+    global ROLLING_WINDOWS, FORECAST_CACHE, FORECAST_CACHE_MONTHS
+    global TENSOR_STORE
+    global LOAD_WORKERS, QUERY_TIMEOUT, FETCH_CHUNK
+    global WORKING_DB_DAYS, WORKING_DB_OVERLAP_DAYS
+    global BACKEND, DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, DUCKDB_TEMP
+    global TELEGRAM_API, TELEGRAM_DIGEST, TELEGRAM_FLUSH_TIMEOUT, R2_DROP
+    global VINTAGE_CUTOFFS, VINTAGE_MAX_AGE, VINTAGE_DAYS
+    global WATCH_INTERVAL, WATCH_HOST, WATCH_PORT
+    global RUN_REPORT, COMPACT, VALUE_DTYPE, GTP_CAPACITY, EXCLUDED_GTP
+
+    PARTIAL = bool(
+        args.date_from or args.date_to or args.gtp or args.providers
+    )
+    # каждый вызов собирает провайдеров, модели и выгрузки заново
+    # из значений по умолчанию, без остатков прошлой настройки
+    PROVIDERS = {
+        provider: PROVIDERS_DEFAULT[provider]
+        for provider in args.providers or PROVIDERS_DEFAULT
+    }
+    MODELS = provider_models(PROVIDERS)
+    OUTPUT_DIR = args.output_dir or ("partial_X1" if PARTIAL else "")
+
+    # Настройки для логера
+    if platform == "linux" or platform == "linux2":
+        logging.basicConfig(
+            filename="/var/log/log-execute/model_accuracy.log.txt",
+            level=logging.INFO,
+            format=(
+                "%(asctime)s - %(levelname)s - "
+                "%(funcName)s: %(lineno)d - %(message)s"
+            ),
+        )
+    elif platform == "win32":
+        logging.basicConfig(
+            filename=(
+                f"{pathlib.Path(__file__).parent.absolute()}"
+                "/model_accuracy.log.txt"
+            ),
+            level=logging.INFO,
+            format=(
+                "%(asctime)s - %(levelname)s - "
+                "%(funcName)s: %(lineno)d - %(message)s"
+            ),
+        )
+
+    # Загружаем yaml файл с настройками
+    if settings is None:
+        import yaml
+
+        with open(
+            f"{pathlib.Path(__file__).parent.absolute()}/settings.yaml", "r"
+        ) as yaml_file:
+            settings = yaml.safe_load(yaml_file)
+    telegram_settings = pd.DataFrame(settings["telegram"])
+    sql_settings = pd.DataFrame(settings["sql_db"])
+    pyodbc_settings = pd.DataFrame(settings["pyodbc_db"])
+    postgresql_settings = pd.DataFrame(settings["postgresql_db"])
+    # Необязательный раздел с настройками расчета точности
+    accuracy_settings = settings.get("model_accuracy") or {}
+
+    # Хранилище статистик по законченным дням и количество дней,
+    # которые пересчитываются перед последним сохраненным днем
+    # (на случай исправлений факта задним числом)
+    SCORE_STORE = accuracy_settings.get(
+        "score_store",
+        f"{pathlib.Path(__file__).parent.absolute()}/score_store_X1.sqlite",
+    )
+    LOOKBACK_DAYS = int(accuracy_settings.get("lookback_days", 3))
+    # Сколько процессов считают статистики (по диапазонам гтп),
+    # 1 - в текущем процессе; ключ --score-workers важнее настройки
+    SCORE_WORKERS = int(
+        args.score_workers or accuracy_settings.get("score_workers", 1)
+    )
+    # Окно в днях, на котором подбираются веса ансамбля провайдеров
+    # (на столько дней раньше начала расчета грузятся факт и прогнозы)
+    ENSEMBLE_DAYS = int(accuracy_settings.get("ensemble_days", 30))
+    # Минимальное покрытие дня гтп прогнозами модели (доля часов
+    # с прогнозом), ниже него день модели в точность не входит;
+    # 0 - считать все дни с хотя бы одним часом прогноза
+    COVERAGE_MIN = float(accuracy_settings.get("coverage_min", 0.5))
+    # Окна скользящей точности в днях
+    ROLLING_WINDOWS = [
+        int(days)
+        for days in accuracy_settings.get("rolling_windows", [7, 30, 90])
+    ]
+
+    # Кэш прогнозов провайдеров и сколько месяцев в нем хранить
+    # (пусто - вся история с someday)
+    FORECAST_CACHE = accuracy_settings.get(
+        "forecast_cache",
+        f"{pathlib.Path(__file__).parent.absolute()}/forecast_cache",
+    )
+    FORECAST_CACHE_MONTHS = accuracy_settings.get("forecast_cache_months")
+    # Почасовое тензорное хранилище факта и прогнозов для разбора по гтп
+    # (пусто - не ведется). Заполняется только полным и инкрементальным
+    # расчетом на backend pandas, сам расчет точности его не читает
+    TENSOR_STORE = accuracy_settings.get("tensor_store")
+
+    # Сколько запросов к базам выполнять одновременно и ограничение
+    # времени одного запроса в секундах (пусто - без ограничения)
+    LOAD_WORKERS = int(accuracy_settings.get("load_workers", 3))
+    # Сколько последних дней хранит основная база прогнозов (старше -
+    # в архиве) и сколько дней у границы читать из обеих баз
+    WORKING_DB_DAYS = int(accuracy_settings.get("working_db_days", 40))
+    WORKING_DB_OVERLAP_DAYS = int(
+        accuracy_settings.get("working_db_overlap_days", 1)
+    )
+    QUERY_TIMEOUT = accuracy_settings.get("query_timeout")
+    # По сколько строк читать результат запроса
+    FETCH_CHUNK = int(accuracy_settings.get("fetch_chunk", 100000))
+
+    # Чем считать склейку, ансамбли и статистики: pandas (в памяти)
+    # или duckdb (встроенная колоночная СУБД поверх parquet кэша,
+    # все ядра, при нехватке памяти сбрасывает данные во временный
+    # каталог)
+    BACKEND = accuracy_settings.get("backend", "pandas")
+    if BACKEND not in ["pandas", "duckdb"]:
+        raise ValueError(f"Неизвестный backend: {BACKEND}")
+    DUCKDB_THREADS = int(
+        accuracy_settings.get("duckdb_threads", os.cpu_count())
+    )
+    DUCKDB_MEMORY_LIMIT = accuracy_settings.get("duckdb_memory_limit")
+    DUCKDB_TEMP = accuracy_settings.get(
+        "duckdb_temp",
+        f"{pathlib.Path(__file__).parent.absolute()}/duckdb_temp",
+    )
+
+    # Сводка запуска в telegram (во все каналы раздела telegram):
+    # адрес api (можно направить на локальный http сервер), сколько
+    # ждать отправки в конце запуска и падение r2 самой точной модели
+    # гтп за последний день против среднего за 7 дней до него,
+    # о котором сообщать
+    TELEGRAM_API = accuracy_settings.get(
+        "telegram_api", "https://api.telegram.org"
+    )
+    TELEGRAM_DIGEST = bool(accuracy_settings.get("telegram_digest", True))
+    TELEGRAM_FLUSH_TIMEOUT = float(
+        accuracy_settings.get("telegram_flush_timeout", 60)
+    )
+    R2_DROP = float(accuracy_settings.get("r2_drop", 0.3))
+
+    # Разбор по срезам времени загрузки (--vintages): срезы "D-<дней>
+    # ЧЧ:ММ" относительно начала суток прогноза, из прогнозов
+    # провайдера берется последний загруженный до среза и не старше
+    # VINTAGE_MAX_AGE часов, и за сколько последних дней считать
+    VINTAGE_CUTOFFS = list(
+        accuracy_settings.get(
+            "vintage_cutoffs", ["D-2 15:00", "D-1 09:00", "D-1 15:00"]
+        )
+    )
+    VINTAGE_MAX_AGE = float(accuracy_settings.get("vintage_max_age", 24))
+    VINTAGE_DAYS = int(accuracy_settings.get("vintage_days", 30))
+
+    # Резидентный режим (--watch): как часто проверять новые часы факта
+    # в секундах и адрес http сервера точности внутри дня
+    # (порт 0 - без сервера)
+    WATCH_INTERVAL = float(accuracy_settings.get("watch_interval", 300))
+    WATCH_HOST = accuracy_settings.get("watch_host", "127.0.0.1")
+    WATCH_PORT = int(accuracy_settings.get("watch_port", 8787))
+
+    # Отчет о запуске (json): время и память этапов, строки и объем
+    # данных по запросам и провайдерам
+    RUN_REPORT = accuracy_settings.get("run_report", RUN_REPORT_DEFAULT)
+
+    # Компактный режим почасовой таблицы факта и прогнозов: значения
+    # float32, date - datetime64 (начало суток), hour - int8 вместо
+    # строк. gtp всегда категориальный, ошибки по модулю считаются только
+    # для выгрузки. На 100 гтп x 365 дней (876 тыс. строк, 7 провайдеров)
+    # таблица занимает 48 МБ вместо 157 МБ в прежнем виде (строковые
+    # gtp/date/hour, float64 и 7 столбцов ошибок)
+    COMPACT = bool(accuracy_settings.get("compact", False))
+    VALUE_DTYPE = "float32" if COMPACT else "float64"
+
+    OUTPUTS = dict(
+        OUTPUTS_DEFAULT, **(accuracy_settings.get("outputs") or {})
+    )
+
+    # Установленная мощность гтп для nmae: гтп -> МВт
+    # (для гтп без мощности берется максимальный часовой факт)
+    GTP_CAPACITY = accuracy_settings.get("gtp_capacity") or {}
+
+    # ГТП, которые не участвуют в расчете точности
+    EXCLUDED_GTP = set(
+        accuracy_settings.get("excluded_gtp", EXCLUDED_GTP_DEFAULT)
+    )
+
+
+# Функции отправки уведомлений в telegram на любое количество каналов
+# (указать данные в yaml файле настроек)
+# На весь запуск одна сессия requests с пулом соединений и повторами,
+# telegram() только ставит сообщение в очередь, отправляет фоновый
+# поток, поэтому недоступность telegram не задерживает расчет.
+# telegram_flush в конце запуска ждет отправки не дольше timeout,
+# requests импортируется в фоновом потоке и не задерживает старт
+
+telegram_queue = queue.Queue()
+telegram_state = {}
+
+
+def telegram_session():
+    if "session" not in telegram_state:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        retry_strategy = Retry(
+            total=3,
+            status_forcelist=[101, 429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            backoff_factor=1,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=len(telegram_settings),
+            pool_maxsize=len(telegram_settings),
+            max_retries=retry_strategy,
+        )
+        http = requests.Session()
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        telegram_state["session"] = http
+    return telegram_state["session"]
+
+
+def telegram_send(i, text):
+    bot_token = str(telegram_settings.bot_token[i])
+    channel_id = str(telegram_settings.channel_id[i])
+    telegram_session().post(
+        f"{TELEGRAM_API}/bot{bot_token}/sendMessage",
+        data={"chat_id": channel_id, "text": text},
+        timeout=10,
+    )
+
+
+def telegram_worker():
+    while True:
+        message = telegram_queue.get()
+        if message is None:
+            return
+        # любая ошибка отправки только пишется в лог, поток продолжает
+        # отправлять следующие сообщения
+        try:
+            telegram_send(*message)
+        except Exception:
+            logging.exception("Не удалось отправить сообщение в telegram")
+
+
+def telegram(i, text):
+    if "thread" not in telegram_state:
+        telegram_state["thread"] = threading.Thread(
+            target=telegram_worker, name="telegram", daemon=True
+        )
+        telegram_state["thread"].start()
+    telegram_queue.put((i, str(text)))
+
+
+def telegram_flush(timeout):
+    thread = telegram_state.get("thread")
+    if thread is None:
+        return
+    telegram_queue.put(None)
+    thread.join(timeout)
+    # следующее сообщение (новый запуск в том же процессе) запустит
+    # новый поток
+    del telegram_state["thread"]
+    if thread.is_alive():
+        logging.warning("Не все сообщения telegram отправлены вовремя.")
+
+
+# Функция коннекта к базе Mysql
+# (для выбора базы задать порядковый номер числом !!! начинается с 0 !!!!!)
+# timeout - ограничение времени ожидания ответа на запрос в секундах
+
+
+def connection(i, timeout=None):
+    import pymysql
+
+    host_yaml = str(sql_settings.host[i])
+    user_yaml = str(sql_settings.user[i])
+    port_yaml = int(sql_settings.port[i])
+    password_yaml = str(sql_settings.password[i])
+    database_yaml = str(sql_settings.database[i])
+    return pymysql.connect(
+        host=host_yaml,
+        user=user_yaml,
+        port=port_yaml,
+        password=password_yaml,
+        database=database_yaml,
+        read_timeout=timeout,
+        write_timeout=timeout,
+    )
+
+
+# Функции хранилища достаточных статистик в sqlite
+# score_stats - по (дата, гтп, модель), только законченные дни;
+# hour_stats - по (дата, гтп, модель, час) за дни, которые еще могут
+# пересчитываться, hour_stats_month - то же, свернутое по месяцам.
+# Метрики считаются из статистик, без обращения к почасовым данным
+
+
+def score_store_connect(path):
+    connection_store = sqlite3.connect(path)
+    statistics_sql = ", ".join(
+        f"{column} {'INTEGER' if column == 'n' else 'REAL'}"
+        for column in STATISTICS
+    )
+    connection_store.execute(
+        "CREATE TABLE IF NOT EXISTS score_stats (date TEXT NOT NULL, gtp TEXT"
+        f" NOT NULL, model TEXT NOT NULL, {statistics_sql}, PRIMARY KEY"
+        " (date, gtp, model));"
+    )
+    connection_store.execute(
+        "CREATE TABLE IF NOT EXISTS hour_stats (date TEXT NOT NULL, gtp TEXT"
+        " NOT NULL, model TEXT NOT NULL, hour INTEGER NOT NULL,"
+        f" {statistics_sql}, PRIMARY KEY (date, gtp, model, hour));"
+    )
+    connection_store.execute(
+        "CREATE TABLE IF NOT EXISTS hour_stats_month (month TEXT NOT NULL,"
+        " gtp TEXT NOT NULL, model TEXT NOT NULL, hour INTEGER NOT NULL,"
+        f" {statistics_sql}, PRIMARY KEY (month, gtp, model, hour));"
+    )
+    # прежняя таблица только с r2, статистики пересчитываются заново
+    connection_store.execute("DROP TABLE IF EXISTS r2_score;")
+    return connection_store
+
+
+def score_store_watermark(connection_store):
+    watermark = connection_store.execute(
+        "SELECT MAX(date) FROM score_stats;"
+    ).fetchone()[0]
+    if watermark is None:
+        return None
+    return datetime.date.fromisoformat(watermark)
+
+
+def score_store_insert(connection_store, table, statistics):
+    columns = [column for column in statistics if column != "between"]
+    connection_store.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES"
+        f" ({', '.join(['?'] * len(columns))});",
+        statistics[columns]
+        .astype("object")
+        .where(statistics[columns].notna(), None)
+        .itertuples(index=False, name=None),
+    )
+
+
+def score_store_save(connection_store, statistics, date_from):
+    with connection_store:
+        connection_store.execute(
+            "DELETE FROM score_stats WHERE date >= ?;", (str(date_from),)
+        )
+        score_store_insert(connection_store, "score_stats", statistics)
+
+
+def score_store_load(connection_store):
+    return pd.read_sql_query(
+        f"SELECT date, gtp, model, {', '.join(STATISTICS)} FROM score_stats;",
+        connection_store,
+    )
+
+
+# Функция начала пересчета с учетом почасового хранилища: если месяц
+# date_from уже свернут в hour_stats_month, дни месяца до date_from
+# по отдельности не сохранились, поэтому месяц пересчитывается целиком
+# с первого дня
+
+
+def hour_store_date_from(connection_store, date_from):
+    folded = connection_store.execute(
+        "SELECT 1 FROM hour_stats_month WHERE month = ? LIMIT 1;",
+        (f"{date_from:%Y-%m}",),
+    ).fetchone()
+    if folded is None:
+        return date_from
+    return date_from.replace(day=1)
+
+
+# Сохранение почасовых статистик окна расчета. Дни раньше month_from
+# больше не пересчитываются, поэтому они (вместе с такими же днями,
+# оставшимися в hour_stats от прошлых запусков) сворачиваются
+# в hour_stats_month, так что hour_stats не растет с историей.
+# hour_statistics: period (день или начало месяца, если день раньше
+# month_from), gtp, model, hour и статистики. date_from внутри уже
+# свернутого месяца - ошибка (начало берется из hour_store_date_from)
+
+
+def hour_store_save(connection_store, hour_statistics, date_from, month_from):
+    keys = ["gtp", "model", "hour"]
+    if hour_store_date_from(connection_store, date_from) != date_from:
+        raise ValueError(
+            f"Месяц {date_from:%Y-%m} уже свернут в hour_stats_month,"
+            " пересчет нужно начинать с первого дня месяца"
+        )
+    with connection_store:
+        connection_store.execute(
+            "DELETE FROM hour_stats WHERE date >= ?;", (str(date_from),)
+        )
+        connection_store.execute(
+            "DELETE FROM hour_stats_month WHERE month >= ?;",
+            (f"{date_from:%Y-%m}",),
+        )
+        hour_closed = pd.read_sql_query(
+            f"SELECT date, {', '.join(keys + STATISTICS)} FROM hour_stats"
+            " WHERE date < ?;",
+            connection_store,
+            params=(str(month_from),),
+        )
+        connection_store.execute(
+            "DELETE FROM hour_stats WHERE date < ?;", (str(month_from),)
+        )
+        hour_statistics = hour_statistics.rename(columns={"period": "date"})
+        closed = hour_statistics["date"] < str(month_from)
+        score_store_insert(
+            connection_store, "hour_stats", hour_statistics[~closed]
+        )
+        hour_closed = pd.concat(
+            [hour_closed, hour_statistics[closed]], ignore_index=True
+        )
+        if hour_closed.empty:
+            return
+        hour_closed["month"] = hour_closed["date"].str[:7]
+        months = sorted(hour_closed["month"].unique())
+        months_sql = ", ".join(["?"] * len(months))
+        hour_month = pd.read_sql_query(
+            f"SELECT month, {', '.join(keys + STATISTICS)} FROM"
+            f" hour_stats_month WHERE month IN ({months_sql});",
+            connection_store,
+            params=months,
+        )
+        hour_month = statistics_combine(
+            pd.concat(
+                [hour_month, hour_closed.drop(columns="date")],
+                ignore_index=True,
+            ),
+            ["month"] + keys,
+        )
+        connection_store.execute(
+            f"DELETE FROM hour_stats_month WHERE month IN ({months_sql});",
+            months,
+        )
+        score_store_insert(connection_store, "hour_stats_month", hour_month)
+
+
+def hour_store_load(connection_store):
+    columns = ", ".join(["gtp", "model", "hour"] + STATISTICS)
+    return pd.read_sql_query(
+        f"SELECT {columns} FROM hour_stats UNION ALL SELECT {columns} FROM"
+        " hour_stats_month;",
+        connection_store,
+    )
+
+
+# Функция расчета достаточных статистик всех моделей по группам ключей
+# за один проход: строки один раз сортируются по ключам (np.lexsort по
+# кодам), дальше суммы по всем группам и моделям считаются через
+# np.add.reduceat. keys: столбец результата -> значения ключа по строкам
+# dataframe, порядок ключей - порядок сортировки.
+# Статистики складываются между группами (statistics_combine), поэтому
+# из них без повторного прохода по почасовым данным считаются любые
+# метрики и периоды. sum_e2 и ss_tot (сумма квадратов отклонений факта
+# от среднего группы) хранятся отдельно, чтобы r2 не терял точность
+# на вычитании сумм, постоянный факт в группе (например нулевая
+# выработка за день) дает ss_tot = 0
+
+
+def score_statistics(dataframe, models, keys):
+    key_codes = [
+        pd.factorize(np.asarray(values), sort=True)[0]
+        for values in keys.values()
+    ]
+    order = np.lexsort(key_codes[::-1])
+    starts, group_statistics = statistics_sorted(
+        dataframe["fact"].to_numpy(dtype="float64")[order],
+        dataframe[list(models.values())].to_numpy(dtype="float64")[order],
+        [codes[order] for codes in key_codes],
+    )
+    first_rows = order[starts]
+    return statistics_frame(
+        {key: np.asarray(values)[first_rows] for key, values in keys.items()},
+        models,
+        group_statistics,
+    )
+
+
+# Функция статистик по строкам, уже отсортированным по кодам ключей
+# key_codes. Возвращает начала групп и статистики групп
+# (по моделям - столбцы y_pred). Считаются только часы, где есть и факт,
+# и прогноз модели (маска valid по каждой модели), поэтому n, sum_y,
+# sum_y2, ss_tot и max_y тоже свои у каждой модели
+
+
+def statistics_sorted(y_true, y_pred, key_codes):
+    rows_count = len(y_true)
+    group_start = np.zeros(rows_count, dtype=bool)
+    group_start[:1] = True
+    for codes in key_codes:
+        group_start[1:] |= codes[1:] != codes[:-1]
+    starts = np.flatnonzero(group_start)
+    counts = np.diff(np.append(starts, rows_count))
+    valid = ~np.isnan(y_pred) & ~np.isnan(y_true)[:, None]
+    y = np.where(valid, y_true[:, None], 0.0)
+    p = np.where(valid, y_pred, 0.0)
+    error = p - y
+
+    n = np.add.reduceat(valid, starts, dtype="int64")
+    sum_y = np.add.reduceat(y, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_y = sum_y / n
+    deviation = np.where(valid, y - np.repeat(mean_y, counts, axis=0), 0.0)
+    ss_tot = np.add.reduceat(deviation**2, starts)
+    max_y = np.maximum.reduceat(
+        np.where(valid, y_true[:, None], -np.inf), starts
+    )
+    min_y = np.minimum.reduceat(
+        np.where(valid, y_true[:, None], np.inf), starts
+    )
+    ss_tot[min_y == max_y] = 0.0
+    return starts, {
+        "n": n,
+        "sum_y": sum_y,
+        "sum_y2": np.add.reduceat(y**2, starts),
+        "sum_p": np.add.reduceat(p, starts),
+        "sum_p2": np.add.reduceat(p**2, starts),
+        "sum_yp": np.add.reduceat(y * p, starts),
+        "sum_e2": np.add.reduceat(error**2, starts),
+        "sum_abs_e": np.add.reduceat(np.abs(error), starts),
+        "ss_tot": ss_tot,
+        "max_y": max_y,
+    }
+
+
+# Функция длинной таблицы статистик: группы повторяются для каждой
+# модели. group_keys: столбец -> значения ключа по группам.
+# Группы, в которых у модели нет ни одного часа с прогнозом, не выводятся
+
+
+def statistics_frame(group_keys, models, group_statistics):
+    models_count = len(models)
+    groups_count = len(group_statistics["n"])
+    statistics = pd.DataFrame(
+        {
+            **{
+                key: np.tile(values, models_count)
+                for key, values in group_keys.items()
+            },
+            "model": np.repeat(list(models.keys()), groups_count),
+            **{
+                name: (
+                    values.ravel(order="F")
+                    if values.ndim == 2
+                    else np.tile(values, models_count)
+                )
+                for name, values in group_statistics.items()
+            },
+        }
+    )
+    return statistics[statistics["n"].to_numpy() > 0].reset_index(drop=True)
+
+
+# Функция покрытия моделей по группам keys: доля часов группы с фактом,
+# в которых у модели есть прогноз. У групп с покрытием ниже threshold
+# прогнозы модели в dataframe заменяются на nan (столбец заменяется
+# целиком, исходные данные не меняются), поэтому такие группы не
+# попадают в статистики. Возвращает длинную таблицу покрытия: ключи,
+# model, hours, valid_hours, coverage и skipped (группа пропущена)
+
+
+def score_coverage(dataframe, models, keys, threshold):
+    group_code = np.zeros(len(dataframe), dtype="int64")
+    for key_values in keys.values():
+        codes, uniques = pd.factorize(np.asarray(key_values), sort=True)
+        group_code = group_code * len(uniques) + codes
+    _, first_rows, group = np.unique(
+        group_code, return_index=True, return_inverse=True
+    )
+    groups_count = len(first_rows)
+    fact_valid = dataframe["fact"].notna().to_numpy()
+    hours = np.bincount(group, weights=fact_valid, minlength=groups_count)
+    coverage = []
+    for model, column in models.items():
+        values = dataframe[column].to_numpy()
+        valid_hours = np.bincount(
+            group,
+            weights=fact_valid & ~np.isnan(values),
+            minlength=groups_count,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = valid_hours / hours
+        skipped = ratio < threshold
+        if skipped.any():
+            values = values.copy()
+            values[skipped[group]] = np.nan
+            dataframe[column] = values
+        coverage.append(
+            pd.DataFrame(
+                {
+                    **{
+                        key: np.asarray(key_values)[first_rows]
+                        for key, key_values in keys.items()
+                    },
+                    "model": model,
+                    "hours": hours.astype("int64"),
+                    "valid_hours": valid_hours.astype("int64"),
+                    "coverage": ratio,
+                    "skipped": skipped,
+                }
+            )
+        )
+    return pd.concat(coverage, ignore_index=True)
+
+
+# Функция статистик score_statistics, разбитая по гтп на пул из workers
+# процессов (для полного пересчета истории). Строки один раз
+# сортируются по ключам и раскладываются в .npy файлы во временном
+# каталоге, каждый процесс открывает их через np.load(mmap_mode="r")
+# и считает свой диапазон гтп (первый ключ в keys), датафрейм
+# процессам не передается. Диапазоны - целые гтп примерно поровну
+# строк, по 4 на процесс; результаты склеиваются в порядке диапазонов,
+# поэтому таблица совпадает с score_statistics до бита.
+# Процессы создаются через forkserver (на windows - spawn), а не fork:
+# в расчете работают фоновые потоки (выгрузка почасовой таблицы через
+# pyarrow, отправка в telegram), и копия процесса с чужими
+# захваченными блокировками может зависнуть. Процесс пула импортирует
+# модуль заново (импорт ничего не настраивает), statistics_shard нужны
+# только numpy и пути к файлам. workers <= 1 - считается в текущем
+# процессе
+
+
+def score_statistics_parallel(dataframe, models, keys, workers):
+    if workers <= 1 or len(dataframe) == 0:
+        return score_statistics(dataframe, models, keys)
+    key_factorized = [
+        pd.factorize(np.asarray(values), sort=True)
+        for values in keys.values()
+    ]
+    order = np.lexsort([codes for codes, _ in key_factorized][::-1])
+    rows_count = len(order)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {
+            name: os.path.join(directory, f"{name}.npy")
+            for name in ["y_true", "y_pred", "key_codes"]
+        }
+        y_true = np.lib.format.open_memmap(
+            paths["y_true"], "w+", "float64", (rows_count,)
+        )
+        np.take(dataframe["fact"].to_numpy(dtype="float64"), order, out=y_true)
+        # по моделям построчно, чтобы не копировать всю таблицу прогнозов
+        y_pred = np.lib.format.open_memmap(
+            paths["y_pred"], "w+", "float64", (len(models), rows_count)
+        )
+        for number, column in enumerate(models.values()):
+            np.take(
+                dataframe[column].to_numpy(dtype="float64"),
+                order,
+                out=y_pred[number],
+            )
+        key_codes = np.lib.format.open_memmap(
+            paths["key_codes"], "w+", "int64", (len(keys), rows_count)
+        )
+        for number, (codes, _) in enumerate(key_factorized):
+            np.take(codes, order, out=key_codes[number])
+        for memmap in [y_true, y_pred, key_codes]:
+            memmap.flush()
+
+        # границы диапазонов - только на смене гтп
+        gtp_starts = np.flatnonzero(np.diff(key_codes[0])) + 1
+        targets = np.linspace(0, rows_count, workers * 4 + 1)[1:-1]
+        position = np.searchsorted(gtp_starts, targets)
+        cuts = gtp_starts[position[position < len(gtp_starts)]]
+        bounds = np.unique(np.concatenate([[0], cuts, [rows_count]]))
+        shards = [
+            (paths, start, end) for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            ),
+        ) as executor:
+            results = list(executor.map(statistics_shard, shards))
+
+        starts = np.concatenate(
+            [
+                start + shard_starts
+                for (_, start, _), (shard_starts, _) in zip(shards, results)
+            ]
+        )
+        group_statistics = {
+            name: np.concatenate(
+                [shard_statistics[name] for _, shard_statistics in results]
+            )
+            for name in results[0][1]
+        }
+        group_keys = {
+            key: np.asarray(uniques)[key_codes[number][starts]]
+            for number, (key, (_, uniques)) in enumerate(
+                zip(keys, key_factorized)
+            )
+        }
+        del y_true, y_pred, key_codes
+    return statistics_frame(group_keys, models, group_statistics)
+
+
+# Функция процесса пула: статистики строк [start, end) из .npy файлов
+
+
+def statistics_shard(shard):
+    paths, start, end = shard
+    y_true = np.load(paths["y_true"], mmap_mode="r")[start:end]
+    y_pred = np.load(paths["y_pred"], mmap_mode="r")[:, start:end]
+    key_codes = np.load(paths["key_codes"], mmap_mode="r")[:, start:end]
+    return statistics_sorted(
+        np.asarray(y_true), np.asarray(y_pred).T, list(key_codes)
+    )
+
+
+# Функция ss_tot объединения групп: сумма ss_tot частей плюс разброс
+# средних частей, sum(sum_y^2 / n) - sum(sum_y)^2 / N. Остаток
+# округления при постоянном факте во всех частях обнуляется, иначе r2
+# такой группы был бы огромным отрицательным вместо 0.0 / 1.0
+
+
+def combined_ss_tot(ss_tot, between, sum_y, sum_y2, n):
+    ss_tot = np.array(ss_tot + between - sum_y**2 / n, dtype="float64")
+    ss_tot[ss_tot <= 1e-12 * np.asarray(sum_y2, dtype="float64")] = 0.0
+    return ss_tot
+
+
+# Функция сложения статистик по группам keys
+
+
+def statistics_combine(statistics, keys):
+    statistics = statistics.assign(
+        between=statistics["sum_y"] ** 2 / statistics["n"]
+    )
+    aggregation = {column: "sum" for column in STATISTICS}
+    aggregation["max_y"] = "max"
+    aggregation["between"] = "sum"
+    combined = statistics.groupby(keys, sort=True).agg(aggregation)
+    combined["ss_tot"] = combined_ss_tot(
+        combined["ss_tot"],
+        combined["between"],
+        combined["sum_y"],
+        combined["sum_y2"],
+        combined["n"],
+    )
+    return combined.drop(columns="between").reset_index()
+
+
+# Функция расчета метрик из достаточных статистик по группам keys
+# r2 - как sklearn.metrics.r2_score: меньше двух часов -> nan,
+# ss_tot = 0 -> 1.0 при точном прогнозе, иначе 0.0;
+# mae, rmse, bias (средняя ошибка прогноз - факт) и nmae (mae к мощности
+# гтп из GTP_CAPACITY, если мощность не задана - к максимальному
+# часовому факту гтп в статистиках)
+
+
+def score_metrics(statistics, keys):
+    metrics = statistics[keys].copy()
+    n = statistics["n"].to_numpy(dtype="float64")
+    sum_e2 = statistics["sum_e2"].to_numpy(dtype="float64")
+    ss_tot = statistics["ss_tot"].to_numpy(dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = np.where(
+            ss_tot != 0,
+            1 - sum_e2 / ss_tot,
+            np.where(sum_e2 != 0, 0.0, 1.0),
+        )
+        r2[n < 2] = np.nan
+        metrics["r2"] = r2
+        metrics["mae"] = statistics["sum_abs_e"].to_numpy() / n
+        metrics["rmse"] = np.sqrt(sum_e2 / n)
+        metrics["bias"] = (
+            statistics["sum_p"].to_numpy() - statistics["sum_y"].to_numpy()
+        ) / n
+        capacity = (
+            statistics["gtp"]
+            .map(GTP_CAPACITY)
+            .fillna(statistics.groupby("gtp")["max_y"].transform("max"))
+            .to_numpy(dtype="float64")
+        )
+        metrics["nmae"] = np.where(
+            capacity > 0, metrics["mae"].to_numpy() / capacity, np.nan
+        )
+    return metrics
+
+
+# Функция скользящих статистик за последние days дней на каждую дату
+# Статистики по (гтп, модель) сортируются по дате и накапливаются
+# np.cumsum, сумма окна - разность двух накопленных сумм, поэтому
+# каждое окно стоит O(1) при любой длине. max_y окна не накапливается,
+# для nmae берется максимум гтп за всю историю
+
+
+def statistics_rolling(statistics, days):
+    statistics = statistics.sort_values(
+        ["gtp", "model", "date"], kind="mergesort", ignore_index=True
+    )
+    group = statistics.groupby(["gtp", "model"], sort=False).ngroup()
+    day = (
+        pd.to_datetime(statistics["date"]).to_numpy(dtype="datetime64[D]")
+    ).astype("int64")
+    key = group.to_numpy(dtype="int64") * 2**20 + day
+
+    additive = [column for column in STATISTICS if column != "max_y"]
+    values = statistics[additive].to_numpy(dtype="float64")
+    values = np.column_stack(
+        [values, statistics["sum_y"] ** 2 / statistics["n"]]
+    )
+    cumulative = np.vstack(
+        [np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)]
+    )
+
+    rolling = []
+    for window in days:
+        lower = np.searchsorted(key, key - window + 1, side="left")
+        sums = cumulative[1:] - cumulative[lower]
+        window_statistics = pd.DataFrame(sums[:, :-1], columns=additive)
+        window_statistics["ss_tot"] = combined_ss_tot(
+            window_statistics["ss_tot"],
+            sums[:, -1],
+            window_statistics["sum_y"],
+            window_statistics["sum_y2"],
+            window_statistics["n"],
+        )
+        window_statistics["max_y"] = statistics.groupby("gtp")[
+            "max_y"
+        ].transform("max")
+        window_statistics.insert(0, "window", window)
+        window_statistics.insert(0, "model", statistics["model"])
+        window_statistics.insert(0, "gtp", statistics["gtp"])
+        window_statistics.insert(0, "date", statistics["date"])
+        rolling.append(window_statistics)
+    return pd.concat(rolling, ignore_index=True)
+
+
+# Функция расчета сводных таблиц точности из хранилища статистик:
+# по неделям (week - понедельник недели), по месяцам, по часам суток
+# за всю историю и скользящие за ROLLING_WINDOWS дней
+
+
+def score_rollups(connection_store):
+    statistics = score_store_load(connection_store)
+    date = pd.to_datetime(statistics["date"])
+    week = statistics.assign(
+        week=(date - pd.to_timedelta(date.dt.weekday, unit="D")).dt.strftime(
+            "%Y-%m-%d"
+        )
+    )
+    month = statistics.assign(month=statistics["date"].str[:7])
+    return {
+        "rollup_week": score_metrics(
+            statistics_combine(week, ["week", "gtp", "model"]),
+            ["week", "gtp", "model"],
+        ),
+        "rollup_month": score_metrics(
+            statistics_combine(month, ["month", "gtp", "model"]),
+            ["month", "gtp", "model"],
+        ),
+        "rollup_hour": score_metrics(
+            statistics_combine(
+                hour_store_load(connection_store), ["gtp", "model", "hour"]
+            ),
+            ["gtp", "model", "hour"],
+        ),
+        "rollup_rolling": score_metrics(
+            statistics_rolling(statistics, ROLLING_WINDOWS),
+            ["date", "gtp", "model", "window"],
+        ),
+    }
+
+
+# Функция итоговых таблиц r2: по дням и гтп со столбцом самой точной
+# модели и самая точная модель по дням в разрезе гтп с последней строкой
+# most_accurate_model (самая частая модель гтп за всю историю).
+# День гтп, в котором r2 нет ни у одной модели (меньше двух часов
+# с прогнозом), остается без самой точной модели (nan)
+
+
+def r2_summary(metrics):
+    r2_score_dataframe = metrics.pivot(
+        index=["date", "gtp"], columns="model", values="r2"
+    ).reindex(columns=list(MODELS))
+    r2_score_dataframe.columns.name = None
+    r2_score_dataframe.reset_index(inplace=True)
+
+    # Добавляем столбик с названием самой точной модели
+    r2_values = r2_score_dataframe.drop(["gtp", "date"], axis="columns")
+    has_r2 = r2_values.notna().any(axis=1)
+    r2_score_dataframe["model"] = (
+        r2_values[has_r2].idxmax(axis=1).reindex(r2_values.index)
+    )
+    r2_score_dataframe["date"] = r2_score_dataframe["date"].astype(
+        "datetime64[ns]"
+    )
+    r2_score_dataframe["gtp"] = r2_score_dataframe["gtp"].astype("str")
+    r2_score_dataframe.sort_values(["gtp", "date"], inplace=True)
+    r2_score_dataframe.reset_index(drop=True, inplace=True)
+
+    r2_score_by_gtp = r2_score_dataframe.pivot(
+        index="date", columns="gtp", values="model"
+    )
+    r2_score_by_gtp.reset_index(inplace=True)
+    most_accurate_model_dict = {"date": "most_accurate_model"}
+    for col in range(1, r2_score_by_gtp.shape[1]):
+        mode = r2_score_by_gtp.iloc[:, col].mode()
+        most_accurate_model_dict[r2_score_by_gtp.iloc[:, col].name] = (
+            mode[0] if len(mode) else np.nan
+        )
+    r2_score_by_gtp = pd.concat(
+        [r2_score_by_gtp, pd.DataFrame([most_accurate_model_dict])],
+        ignore_index=True,
+    )
+    return r2_score_dataframe, r2_score_by_gtp
+
+
+# Функции отчета о запуске
+# Этапы основного потока идут друг за другом: report_stage(name)
+# закрывает текущий этап (время, пиковая память tracemalloc с ключом
+# --trace-memory, максимальный RSS процесса) и открывает следующий.
+# report_timed замеряет время функции в любом потоке (параллельная
+# загрузка, фоновая выгрузка), report_rows - строки и объем таблицы
+# (объем в памяти типизированных данных, близкий к объему из базы).
+# report_start начинает отчет нового запуска, report_write вызывается
+# при любом завершении run
+
+run_report = {}
+report_current = {}
+
+
+def report_start(args):
+    run_report.clear()
+    run_report.update(
+        start=datetime.datetime.now().isoformat(timespec="seconds"),
+        args=vars(args),
+        status="failed",
+        stages={},
+        rows={},
+    )
+    report_current.clear()
+
+
+def report_stage(name=None):
+    if report_current:
+        stage = {
+            "seconds": round(time.perf_counter() - report_current["start"], 3)
+        }
+        if tracemalloc.is_tracing():
+            stage["tracemalloc_peak_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 2**20, 1
+            )
+        if resource is not None:
+            # ru_maxrss на linux в КБ
+            stage["max_rss_mb"] = round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1
+            )
+        run_report["stages"][report_current["name"]] = stage
+        logging.info(f"Этап {report_current['name']}: {stage}")
+        report_current.clear()
+    if name is not None:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        report_current.update(name=name, start=time.perf_counter())
+
+
+def report_timed(name, function, *function_args):
+    start = time.perf_counter()
+    try:
+        return function(*function_args)
+    finally:
+        run_report["stages"][name] = {
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+
+
+def report_rows(name, dataframe):
+    run_report["rows"][name] = {
+        "rows": len(dataframe),
+        "bytes": int(dataframe.memory_usage(deep=True).sum()),
+    }
+    return run_report["rows"][name]
+
+
+def report_write(profiler=None, profile=None):
+    report_stage()
+    run_report["end"] = datetime.datetime.now().isoformat(timespec="seconds")
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    try:
+        with open(RUN_REPORT, "w") as report_file:
+            json.dump(run_report, report_file, indent=1, default=str)
+    except OSError:
+        logging.exception(f"Не удалось записать отчет {RUN_REPORT}")
+    if TELEGRAM_DIGEST and not PARTIAL:
+        for message in telegram_digest(run_report):
+            for i in range(len(telegram_settings)):
+                telegram(i, message)
+    telegram_flush(TELEGRAM_FLUSH_TIMEOUT)
+
+
+# Функция гтп, у которых r2 самой точной модели (winners: гтп -> модель)
+# за последний день упал больше чем на R2_DROP против среднего за
+# предыдущие 7 дней
+
+
+def r2_drops(metrics, winners):
+    best = metrics.merge(
+        pd.DataFrame({"gtp": list(winners), "model": list(winners.values())}),
+        on=["gtp", "model"],
+    )
+    r2 = best.pivot(index="date", columns="gtp", values="r2").sort_index()
+    if len(r2) < 2:
+        return []
+    last = r2.iloc[-1]
+    previous = r2.iloc[-8:-1].mean()
+    dropped = (previous - last)[lambda drop: drop > R2_DROP].index
+    return [
+        {
+            "gtp": gtp,
+            "model": winners[gtp],
+            "date": r2.index[-1],
+            "r2": round(float(last[gtp]), 3),
+            "r2_before": round(float(previous[gtp]), 3),
+        }
+        for gtp in dropped
+    ]
+
+
+# Функция сводки запуска для telegram: статус и длительность, время
+# этапов, самая точная модель гтп (гтп сгруппированы по модели) и гтп
+# с резким падением r2. Возвращает список сообщений не длиннее
+# TELEGRAM_MAX_LENGTH
+
+
+def telegram_digest(run_report):
+    lines = [
+        f"Точность моделей X1: {run_report['status']},"
+        f" {run_report['start']} - {run_report.get('end')}"
+    ]
+    lines.extend(
+        f"{name}: {stage['seconds']:.1f} с"
+        for name, stage in run_report["stages"].items()
+    )
+    winners = run_report.get("winners") or {}
+    if winners:
+        lines.append("Самая точная модель:")
+        for model in sorted(set(winners.values())):
+            gtp = sorted(name for name in winners if winners[name] == model)
+            lines.append(f"{model} ({len(gtp)}): {', '.join(gtp)}")
+    for drop in run_report.get("r2_drops") or []:
+        lines.append(
+            f"Падение r2 {drop['gtp']} ({drop['model']}) за {drop['date']}:"
+            f" {drop['r2_before']} -> {drop['r2']}"
+        )
+    messages = [""]
+    for line in lines:
+        line = line[:TELEGRAM_MAX_LENGTH]
+        if len(messages[-1]) + len(line) + 1 > TELEGRAM_MAX_LENGTH:
+            messages.append("")
+        messages[-1] += f"{line}\n"
+    return [message.rstrip("\n") for message in messages]
+
+
+# Функция выгрузки датафрейма в формате из OUTPUTS
+# в каталог directory (по умолчанию OUTPUT_DIR), xlsx не влезающий
+# в лист Excel пишется в csv
+
+
+def output_write(dataframe, name, directory=None):
+    output_format = OUTPUTS[name]
+    if output_format == "off":
+        return
+    if directory is None:
+        directory = OUTPUT_DIR
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if output_format == "xlsx" and len(dataframe) > EXCEL_MAX_ROWS:
+        logging.warning(
+            f"{name}: {len(dataframe)} строк не помещается в лист Excel,"
+            " выгрузка в csv."
+        )
+        output_format = "csv"
+    path = os.path.join(directory, f"{OUTPUT_FILES[name]}.{output_format}")
+    if output_format == "parquet":
+        dataframe.to_parquet(path)
+    elif output_format == "csv":
+        dataframe.to_csv(path)
+    elif output_format == "xlsx":
+        excel_write(dataframe, path)
+    else:
+        raise ValueError(
+            f"Неизвестный формат выгрузки {name}: {output_format}"
+        )
+    logging.info(f"Выгрузка {path} записана.")
+
+
+# Функция потоковой записи датафрейма в xlsx
+# xlsxwriter в режиме constant_memory держит в памяти одну строку,
+# поэтому строки пишутся строго по порядку (to_excel пишет по столбцам)
+
+
+def excel_write(dataframe, path):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(
+        path,
+        {
+            "constant_memory": True,
+            "nan_inf_to_errors": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        },
+    )
+    worksheet = workbook.add_worksheet("Sheet1")
+    worksheet.write_row(0, 0, [""] + [str(column) for column in dataframe])
+    for row_number, row in enumerate(
+        dataframe.itertuples(index=True, name=None), start=1
+    ):
+        worksheet.write_row(
+            row_number, 0, [None if pd.isna(value) else value for value in row]
+        )
+    workbook.close()
+
+
+# Функция выгрузки почасовой таблицы вместе с ошибками моделей по модулю
+# (ошибки считаются только здесь)
+
+
+def model_predicts_write(temp_dataframe, directory=None):
+    output_write(
+        temp_dataframe.assign(
+            **{
+                provider: abs(
+                    temp_dataframe["fact"]
+                    - temp_dataframe[f"value_{provider}"]
+                )
+                for provider in PROVIDERS
+            }
+        ),
+        "model_predicts",
+        directory,
+    )
+
+
+# Функция потокового чтения результата запроса частями по chunk_size строк
+# Каждая часть сразу раскладывается в типизированные numpy буферы
+# (при заполнении буферы растут вдвое), поэтому кортежи python живут
+# только в пределах одной части. columns: столбец -> dtype,
+# для строковых столбцов "category" (в буфере хранятся коды)
+
+
+def fetch_typed(cursor, columns, chunk_size):
+    capacity = chunk_size
+    buffers = {
+        column: np.empty(
+            capacity, dtype="int32" if dtype == "category" else dtype
+        )
+        for column, dtype in columns.items()
+    }
+    categories = {
+        column: {}
+        for column, dtype in columns.items()
+        if dtype == "category"
+    }
+    rows_count = 0
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        chunk_rows = len(chunk)
+        if rows_count + chunk_rows > capacity:
+            capacity = max(capacity * 2, rows_count + chunk_rows)
+            for column in buffers:
+                buffers[column] = np.resize(buffers[column], capacity)
+        for column, values in zip(columns, zip(*chunk)):
+            buffer = buffers[column][rows_count : rows_count + chunk_rows]
+            if column in categories:
+                codes, uniques = pd.factorize(
+                    np.asarray(values, dtype=object)
+                )
+                known = categories[column]
+                uniques_codes = np.array(
+                    [
+                        known.setdefault(unique, len(known))
+                        for unique in uniques
+                    ],
+                    dtype="int32",
+                )
+                buffer[:] = uniques_codes[codes]
+            elif buffer.dtype.kind == "M":
+                # разбор datetime объектов в pandas на порядок быстрее
+                # np.asarray
+                buffer[:] = pd.DatetimeIndex(values).to_numpy(
+                    dtype=buffer.dtype
+                )
+            else:
+                buffer[:] = np.asarray(values, dtype=columns[column])
+        rows_count += chunk_rows
+
+    dataframe = {}
+    for column, buffer in buffers.items():
+        buffer = buffer[:rows_count]
+        if column in categories:
+            # категории по алфавиту, как у обычной сортировки строк
+            names = np.array(list(categories[column]), dtype=object)
+            order = np.argsort(names)
+            recode = np.empty(len(order), dtype="int32")
+            recode[order] = np.arange(len(order), dtype="int32")
+            buffer = pd.Categorical.from_codes(recode[buffer], names[order])
+        dataframe[column] = buffer
+    return pd.DataFrame(dataframe)
+
+
+# Функция подготовки загруженного факта: без дублей (gtp, dt),
+# дата и час из dt без перевода всего столбца в строки
+# (строки формируются только для уникальных дней и 24 часов)
+
+
+def fact_prepare(fact):
+    fact.drop_duplicates(
+        subset=["gtp", "dt"], keep="last", inplace=True, ignore_index=False
+    )
+    date = fact["dt"].dt.normalize()
+    hour = fact["dt"].dt.hour.astype("int8")
+    if COMPACT:
+        fact["date"] = date
+        fact["hour"] = hour
+    else:
+        date_codes, dates = pd.factorize(date)
+        fact["date"] = np.asarray(dates.strftime("%Y-%m-%d"), dtype=object)[
+            date_codes
+        ]
+        fact["hour"] = np.array(
+            [f"{number:02d}" for number in range(24)], dtype=object
+        )[hour.to_numpy()]
+    return fact
+
+
+# Функции кэша прогнозов провайдеров
+# Кэш лежит в parquet файлах FORECAST_CACHE/<провайдер>/<ГГГГ-ММ>.parquet
+# (месяц по dt) с типизированными столбцами gtp, dt, load_time, value.
+# Архивные прогнозы не меняются, поэтому в кэш только дописываются строки
+# новее последнего load_time; месяц при дописывании пересобирается в один
+# файл без дублей (gtp, dt), месяцы старше FORECAST_CACHE_MONTHS удаляются.
+# Кэш покрывает dt с первого dt самого раннего месяца: окно расчета,
+# начинающееся раньше, грузится из баз целиком (forecast_cache_start).
+
+
+def forecast_cache_partitions(path, provider):
+    provider_path = pathlib.Path(path, provider)
+    if not provider_path.is_dir():
+        return []
+    return sorted(provider_path.glob("*.parquet"))
+
+
+def forecast_cache_watermark(path, provider):
+    partitions = forecast_cache_partitions(path, provider)
+    if not partitions:
+        return None
+    load_time = pd.read_parquet(partitions[-1], columns=["load_time"])
+    return load_time["load_time"].max().to_pydatetime()
+
+
+def forecast_cache_start(path, provider):
+    partitions = forecast_cache_partitions(path, provider)
+    if not partitions:
+        return None
+    dt = pd.read_parquet(partitions[0], columns=["dt"])
+    return dt["dt"].min().to_pydatetime()
+
+
+def forecast_cache_read(path, provider, date_from):
+    month_from = f"{date_from:%Y-%m}"
+    partitions = [
+        partition
+        for partition in forecast_cache_partitions(path, provider)
+        if partition.stem >= month_from
+    ]
+    if not partitions:
+        return forecast_types(
+            pd.DataFrame(columns=["gtp", "dt", "load_time", "value"])
+        )
+    forecast_dataframe = pd.concat(
+        [pd.read_parquet(partition) for partition in partitions],
+        axis=0,
+        ignore_index=True,
+    )
+    forecast_dataframe = forecast_dataframe[
+        forecast_dataframe["dt"] >= pd.Timestamp(date_from)
+    ]
+    return forecast_dataframe.reset_index(drop=True)
+
+
+def forecast_cache_write(path, provider, forecast_dataframe):
+    if forecast_dataframe.empty:
+        return
+    provider_path = pathlib.Path(path, provider)
+    provider_path.mkdir(parents=True, exist_ok=True)
+    forecast_dataframe = forecast_types(forecast_dataframe)
+    months = forecast_dataframe["dt"].dt.strftime("%Y-%m")
+    for month, forecast_month in forecast_dataframe.groupby(months):
+        partition = provider_path / f"{month}.parquet"
+        if partition.exists():
+            forecast_month = forecast_merge(
+                [pd.read_parquet(partition), forecast_month]
+            )
+        else:
+            forecast_month = forecast_merge([forecast_month])
+        # запись через временный файл, чтобы не оставить битый месяц
+        partition_temp = partition.with_suffix(".parquet.tmp")
+        forecast_month.to_parquet(partition_temp, index=False)
+        os.replace(partition_temp, partition)
+
+
+# keep_from - месяцы с этой даты не удаляются (их читает текущий расчет)
+
+
+def forecast_cache_evict(path, provider, months, keep_from=None):
+    if not months:
+        return
+    month_from = (
+        pd.Timestamp(today) - pd.DateOffset(months=int(months))
+    ).strftime("%Y-%m")
+    if keep_from is not None:
+        month_from = min(month_from, f"{keep_from:%Y-%m}")
+    for partition in forecast_cache_partitions(path, provider):
+        if partition.stem < month_from:
+            partition.unlink()
+
+
+def forecast_cache_clear(path, provider):
+    shutil.rmtree(pathlib.Path(path, provider), ignore_errors=True)
+
+
+# Склейка частей прогнозов провайдера: по (gtp, dt) остается
+# последний загруженный прогноз
+
+
+def forecast_merge(forecast_dataframes):
+    forecast_dataframe = forecast_types(
+        pd.concat(forecast_dataframes, axis=0)
+    ).sort_values(["gtp", "dt", "load_time"], kind="mergesort")
+    return forecast_dataframe.drop_duplicates(
+        subset=["gtp", "dt"], keep="last", ignore_index=True
+    )
+
+
+# Приведение прогнозов к типам кэша
+
+
+def forecast_types(forecast_dataframe):
+    return forecast_dataframe.astype(
+        {
+            "gtp": "category",
+            "dt": "datetime64[ns]",
+            "load_time": "datetime64[ns]",
+            "value": "float64",
+        }
+    )
+
+
+# Функция склейки прогнозов с фактом
+# Ключ строки - целое число (код гтп << 32 | секунды от эпохи по dt),
+# прогноз каждого провайдера один раз сортируется по нему и
+# раскладывается на строки факта через searchsorted, без merge
+# и промежуточных копий растущего датафрейма. Возвращает столбцы
+# value_<провайдер> типа dtype в порядке и с индексом факта
+# (нет прогноза - nan)
+
+
+def forecast_key(gtp, dt, gtp_names):
+    codes, uniques = pd.factorize(gtp)
+    codes = pd.Index(gtp_names).get_indexer(uniques)[codes].astype("int64")
+    seconds = dt.to_numpy(dtype="datetime64[s]").astype("int64")
+    # гтп, которого нет в факте, получает отрицательный ключ без совпадений
+    return np.where(codes >= 0, (codes << 32) | seconds, -1)
+
+
+def forecast_align(fact, forecast_dataframes, dtype="float64"):
+    gtp_names = pd.unique(fact["gtp"])
+    fact_key = forecast_key(fact["gtp"], fact["dt"], gtp_names)
+    aligned = {}
+    for provider, forecast_dataframe in forecast_dataframes.items():
+        key = forecast_key(
+            forecast_dataframe["gtp"], forecast_dataframe["dt"], gtp_names
+        )
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        position = np.searchsorted(key, fact_key)
+        position[position == len(key)] = 0
+        aligned_values = np.full(len(fact_key), np.nan, dtype=dtype)
+        if len(key):
+            found = key[position] == fact_key
+            values = forecast_dataframe["value"].to_numpy(dtype=dtype)
+            aligned_values[found] = values[order][position[found]]
+        aligned[f"value_{provider}"] = aligned_values
+    return pd.DataFrame(aligned, index=fact.index)
+
+
+# Функция почасовой таблицы факта и прогнозов провайдеров
+# (нет прогноза - nan) со средним и максимумом провайдеров, у которых
+# есть прогноз на этот час (нет ни одного - nan)
+
+
+def model_predicts(fact, forecast_dataframes):
+    temp_dataframe = pd.concat(
+        [fact, forecast_align(fact, forecast_dataframes, VALUE_DTYPE)],
+        axis=1,
+    )
+    provider_columns = [f"value_{provider}" for provider in PROVIDERS]
+    temp_dataframe["value_aver"] = temp_dataframe[provider_columns].mean(
+        axis=1
+    )
+    temp_dataframe["value_max"] = temp_dataframe[provider_columns].max(
+        axis=1
+    )
+    return temp_dataframe
+
+
+# Функции почасового тензорного хранилища факта и прогнозов
+# Хранилище лежит в TENSOR_STORE: index.json (начало отсчета часов,
+# каналы fact и провайдеры, тип значений) и по файлу <гтп>.bin на гтп -
+# плотный массив (час от начала отсчета, канал) без заголовка, нет
+# значения - nan. Пишутся все часы гтп факта, на которые есть факт или
+# прогноз хотя бы одного провайдера. Новые дни дописываются в конец
+# файла, пересчитанные часы перезаписываются на месте, остальные
+# страницы файла не трогаются. tensor_store_slice возвращает
+# представление memmap без копирования, поэтому разбор одной гтп за
+# месяц читает с диска только этот месяц. Хранилище - для разборов:
+# расчет точности считает по почасовой таблице в памяти (или в duckdb)
+# и из хранилища не читает
+
+
+def tensor_store_index(path):
+    index_path = pathlib.Path(path, "index.json")
+    if index_path.exists():
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    return {
+        "epoch": f"{someday:%Y-%m-%d}",
+        "channels": ["fact"] + list(PROVIDERS),
+        "dtype": VALUE_DTYPE,
+    }
+
+
+def tensor_store_open(path, gtp, index, hours=None):
+    gtp_path = pathlib.Path(path, f"{gtp}.bin")
+    row_bytes = len(index["channels"]) * np.dtype(index["dtype"]).itemsize
+    stored = gtp_path.stat().st_size // row_bytes if gtp_path.exists() else 0
+    if hours is None:
+        if not stored:
+            return None
+        return np.memmap(
+            gtp_path,
+            dtype=index["dtype"],
+            mode="r",
+            shape=(stored, len(index["channels"])),
+        )
+    hours = max(hours, stored)
+    # memmap в режиме r+/w+ сам дописывает файл нулями до нужной длины,
+    # новые часы сразу заполняются nan
+    tensor = np.memmap(
+        gtp_path,
+        dtype=index["dtype"],
+        mode="r+" if stored else "w+",
+        shape=(hours, len(index["channels"])),
+    )
+    tensor[stored:] = np.nan
+    return tensor
+
+
+def tensor_store_write(path, fact, forecast_dataframes):
+    index = tensor_store_index(path)
+    if index["channels"] != ["fact"] + list(forecast_dataframes):
+        raise ValueError(
+            f"Каналы тензорного хранилища {path}: {index['channels']},"
+            " при смене провайдеров хранилище нужно удалить"
+        )
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    # сетка (gtp, dt): часы факта и прогнозов по гтп факта
+    fact_gtp = pd.unique(fact["gtp"])
+    grid = pd.concat(
+        [fact[["gtp", "dt"]].astype({"gtp": "object"})]
+        + [
+            forecast_dataframe.loc[
+                forecast_dataframe["gtp"].isin(fact_gtp), ["gtp", "dt"]
+            ].astype({"gtp": "object"})
+            for forecast_dataframe in forecast_dataframes.values()
+        ],
+        ignore_index=True,
+    ).drop_duplicates(ignore_index=True)
+    fact_values = fact[["gtp", "dt", "fact"]].rename(columns={"fact": "value"})
+    values = np.column_stack(
+        [
+            forecast_align(grid, {"fact": fact_values}, index["dtype"]),
+            forecast_align(grid, forecast_dataframes, index["dtype"]),
+        ]
+    )
+    hours = (
+        (grid["dt"] - pd.Timestamp(index["epoch"])) // pd.Timedelta(hours=1)
+    ).to_numpy(dtype="int64")
+    codes, gtp_names = pd.factorize(grid["gtp"])
+    order = np.lexsort((hours, codes))
+    codes, hours, values = codes[order], hours[order], values[order]
+    bounds = np.searchsorted(codes, np.arange(len(gtp_names) + 1))
+    for code, gtp in enumerate(gtp_names):
+        gtp_hours = hours[bounds[code] : bounds[code + 1]]
+        gtp_values = values[bounds[code] : bounds[code + 1]]
+        # часы до начала отсчета в хранилище не попадают
+        gtp_values = gtp_values[gtp_hours >= 0]
+        gtp_hours = gtp_hours[gtp_hours >= 0]
+        if not len(gtp_hours):
+            continue
+        tensor = tensor_store_open(path, gtp, index, gtp_hours[-1] + 1)
+        tensor[gtp_hours] = gtp_values
+        tensor.flush()
+        del tensor
+    with open(pathlib.Path(path, "index.json"), "w") as index_file:
+        json.dump(index, index_file)
+
+
+# Функция среза хранилища по гтп и часам dt_from <= dt < dt_to
+# Возвращает часы среза (DatetimeIndex) и представление memmap
+# (час, канал) без копирования, каналы - index["channels"]
+
+
+def tensor_store_slice(path, gtp, dt_from=None, dt_to=None):
+    index = tensor_store_index(path)
+    tensor = tensor_store_open(path, gtp, index)
+    if tensor is None:
+        raise KeyError(f"Гтп {gtp} нет в тензорном хранилище {path}")
+    epoch = pd.Timestamp(index["epoch"])
+    hour = pd.Timedelta(hours=1)
+    hour_from = 0
+    hour_to = len(tensor)
+    if dt_from is not None:
+        hour_from = max(0, (pd.Timestamp(dt_from) - epoch) // hour)
+    if dt_to is not None:
+        hour_to = min(hour_to, (pd.Timestamp(dt_to) - epoch) // hour)
+    hour_to = max(hour_from, hour_to)
+    dt = pd.date_range(
+        epoch + hour * hour_from,
+        periods=hour_to - hour_from,
+        freq="h",
+    )
+    return dt, tensor[hour_from:hour_to]
+
+
+# Функция смещения среза времени загрузки "D-<дней> ЧЧ:ММ" от начала
+# суток прогноза в секундах (D-1 15:00 -> -9 часов)
+
+
+def vintage_offset(cutoff):
+    day, clock = cutoff.split()
+    if not day.startswith("D-"):
+        raise ValueError(f"Срез загрузки не в виде D-1 15:00: {cutoff}")
+    offset = pd.Timedelta(f"{clock}:00") - pd.Timedelta(days=int(day[2:]))
+    return int(offset.total_seconds())
+
+
+# Функция as-of склейки прогнозов всех времен загрузки с фактом
+# Для каждой строки факта и каждого среза из offsets (секунды от начала
+# суток dt) берется последний прогноз той же (гтп, dt), загруженный
+# строго до среза и не раньше чем за max_age секунд до него.
+# Прогноз сортируется один раз по (ключ строки, load_time), ключ группы
+# и время загрузки сводятся в одно возрастающее число
+# (номер группы * span + секунды от первой загрузки), поэтому поиск
+# по всем строкам факта - один searchsorted на срез, без циклов по
+# строкам. Возвращает значения и заблаговременность в часах
+# (dt - load_time), массивы (строки факта, срезы), нет прогноза - nan
+
+
+def forecast_asof(fact, forecast_dataframe, offsets, max_age, dtype):
+    values = np.full((len(fact), len(offsets)), np.nan, dtype=dtype)
+    lead = np.full((len(fact), len(offsets)), np.nan, dtype="float64")
+    if forecast_dataframe.empty or fact.empty:
+        return values, lead
+    gtp_names = pd.unique(fact["gtp"])
+    fact_key = forecast_key(fact["gtp"], fact["dt"], gtp_names)
+    key = forecast_key(
+        forecast_dataframe["gtp"], forecast_dataframe["dt"], gtp_names
+    )
+    load_seconds = (
+        forecast_dataframe["load_time"]
+        .to_numpy(dtype="datetime64[s]")
+        .astype("int64")
+    )
+    order = np.lexsort((load_seconds, key))
+    key = key[order]
+    load_seconds = load_seconds[order]
+    forecast_values = forecast_dataframe["value"].to_numpy(dtype=dtype)[order]
+
+    keys_unique, group = np.unique(key, return_inverse=True)
+    load_min = load_seconds.min()
+    span = load_seconds.max() - load_min + 2
+    composite = group * span + (load_seconds - load_min)
+    fact_group = np.searchsorted(keys_unique, fact_key)
+    fact_group[fact_group == len(keys_unique)] = 0
+    has_group = keys_unique[fact_group] == fact_key
+    dt_seconds = fact["dt"].to_numpy(dtype="datetime64[s]").astype("int64")
+    day_seconds = dt_seconds - dt_seconds % 86400
+    for j, offset in enumerate(offsets):
+        # последняя загрузка строго до среза
+        cutoff = day_seconds + offset - 1
+        target = fact_group * span + np.clip(cutoff - load_min, -1, span - 1)
+        position = np.searchsorted(composite, target, side="right") - 1
+        found = has_group & (position >= 0)
+        position = np.maximum(position, 0)
+        found &= composite[position] // span == fact_group
+        found &= load_seconds[position] > cutoff - max_age
+        values[found, j] = forecast_values[position[found]]
+        lead[found, j] = (
+            dt_seconds[found] - load_seconds[position[found]]
+        ) / 3600
+    return values, lead
+
+
+# Функция точности провайдеров по срезам времени загрузки
+# Все пары (провайдер, срез) считаются одним проходом score_statistics
+# как отдельные модели "<провайдер> <срез>" по гтп и по всем гтп вместе
+# (gtp = all). Метрики считаются только по часам, где прогноз к срезу
+# есть, рядом с ними выводится покрытие (доля часов с прогнозом)
+# и средняя заблаговременность в часах
+
+
+def vintage_metrics(fact, forecast_dataframes, cutoffs, max_age):
+    offsets = [vintage_offset(cutoff) for cutoff in cutoffs]
+    columns = {}
+    models = {}
+    for provider, forecast_dataframe in forecast_dataframes.items():
+        values, lead = forecast_asof(
+            fact, forecast_dataframe, offsets, max_age * 3600, VALUE_DTYPE
+        )
+        for j, cutoff in enumerate(cutoffs):
+            model = f"{provider} {cutoff}"
+            models[model] = f"value_{provider}_{j}"
+            columns[models[model]] = values[:, j]
+            columns[f"lead_{provider}_{j}"] = lead[:, j]
+    frame = pd.concat(
+        [
+            fact[["gtp", "fact"]].reset_index(drop=True),
+            pd.DataFrame(columns),
+        ],
+        axis=1,
+    )
+    gtp_codes, gtp_names = pd.factorize(frame["gtp"], sort=True)
+    coverage = []
+    for model, column in models.items():
+        lead = frame[column.replace("value_", "lead_", 1)].to_numpy()
+        found = ~np.isnan(lead)
+        rows = np.bincount(gtp_codes, minlength=len(gtp_names))
+        found_rows = np.bincount(
+            gtp_codes, weights=found, minlength=len(gtp_names)
+        )
+        lead_sum = np.bincount(
+            gtp_codes,
+            weights=np.where(found, lead, 0.0),
+            minlength=len(gtp_names),
+        )
+        coverage.append(
+            pd.DataFrame(
+                {
+                    "gtp": list(gtp_names) + ["all"],
+                    "model": model,
+                    "rows": np.append(rows, rows.sum()),
+                    "found": np.append(found_rows, found_rows.sum()),
+                    "lead_sum": np.append(lead_sum, lead_sum.sum()),
+                }
+            )
+        )
+    coverage = pd.concat(coverage, ignore_index=True)
+
+    statistics = score_statistics(frame, models, {"gtp": frame["gtp"]})
+    statistics["gtp"] = statistics["gtp"].astype(str)
+    statistics = pd.concat(
+        [
+            statistics,
+            statistics_combine(statistics, ["model"]).assign(gtp="all"),
+        ],
+        ignore_index=True,
+    )
+    # гтп без прогноза к срезу остаются в таблице с пустыми метриками
+    metrics = score_metrics(statistics, ["gtp", "model"]).merge(
+        coverage, on=["gtp", "model"], how="right"
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["coverage"] = metrics["found"] / metrics["rows"]
+        metrics["lead_hours"] = metrics["lead_sum"] / metrics["found"]
+    model_names = pd.DataFrame(
+        [
+            {
+                "model": f"{provider} {cutoff}",
+                "provider": provider,
+                "cutoff": cutoff,
+            }
+            for provider in forecast_dataframes
+            for cutoff in cutoffs
+        ]
+    )
+    metrics = metrics.merge(model_names, on="model")
+    return metrics[
+        [
+            "gtp",
+            "provider",
+            "cutoff",
+            "r2",
+            "mae",
+            "rmse",
+            "bias",
+            "nmae",
+            "coverage",
+            "lead_hours",
+        ]
+    ]
+
+
+# Функция подбора неотрицательных весов ансамбля для батча задач
+# min |X w - y|^2, w >= 0, заданных матрицами gram = X'X (batch, k, k)
+# и xy = X'y (batch, k). Покоординатный спуск идет сразу по всему батчу
+# (цикл только по итерациям и k провайдерам), небольшая регуляризация
+# по диагонали делает задачу строго выпуклой
+
+
+def ensemble_nnls(gram, xy, iterations=100):
+    batch_count, k = xy.shape
+    diagonal = np.arange(k)
+    ridge = 1e-6 * gram[:, diagonal, diagonal].mean(axis=1) + 1e-12
+    gram = gram.copy()
+    gram[:, diagonal, diagonal] += ridge[:, None]
+    weights = np.full((batch_count, k), 1 / k)
+    for _ in range(iterations):
+        for j in range(k):
+            gradient = (
+                np.einsum("bk,bk->b", gram[:, j, :], weights) - xy[:, j]
+            )
+            weights[:, j] = np.maximum(
+                weights[:, j] - gradient / gram[:, j, j], 0.0
+            )
+    return weights
+
+
+# Функция весов ансамбля по каждой паре (гтп, день) на скользящем окне
+# из days предыдущих дней (текущий день в подбор не входит).
+# group_key - отсортированные ключи пар (код гтп * 2**20 + номер дня),
+# daily - дневные X'X (k * k столбцов) и X'y (k столбцов) пар.
+# Окно - разность накопленных сумм, веса всех пар подбираются одним
+# батчем ensemble_nnls. Без истории (первый день гтп) веса равные,
+# т.е. прогноз совпадает со средним провайдеров
+
+
+def ensemble_weights(group_key, daily, k, days):
+    cumulative = np.vstack(
+        [np.zeros((1, daily.shape[1])), np.cumsum(daily, axis=0)]
+    )
+    lower = np.searchsorted(group_key, group_key - days, side="left")
+    upper = np.searchsorted(group_key, group_key, side="left")
+    window = cumulative[upper] - cumulative[lower]
+
+    gram = window[:, : k * k].reshape(-1, k, k)
+    weights = ensemble_nnls(gram, window[:, k * k :])
+    weights[upper == lower] = 1 / k
+    return weights
+
+
+# Функция прогноза ансамбля с весами ensemble_weights
+# Дневные X'X и X'y по парам (гтп, день) считаются через np.add.reduceat.
+# Пропущенный час провайдера и в подборе весов, и в прогнозе заменяется
+# средним провайдеров, у которых прогноз на этот час есть; час без
+# прогнозов в подбор не входит, прогноз ансамбля на него - nan.
+# Час без факта в подбор весов тоже не входит, прогноз на него есть
+
+
+def ensemble_predict(dataframe, columns, days, dtype="float64"):
+    gtp_codes = pd.factorize(dataframe["gtp"], sort=True)[0].astype("int64")
+    day = (
+        dataframe["dt"].to_numpy(dtype="datetime64[D]").astype("int64")
+    )
+    key = gtp_codes * 2**20 + day
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    rows_count = len(key)
+    group_start = np.ones(rows_count, dtype=bool)
+    group_start[1:] = key[1:] != key[:-1]
+    starts = np.flatnonzero(group_start)
+    group_key = key[starts]
+
+    x = dataframe[columns].to_numpy(dtype="float64")[order]
+    y = dataframe["fact"].to_numpy(dtype="float64")[order]
+    k = len(columns)
+    missing = np.isnan(x)
+    available = k - missing.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(missing, 0.0, x).sum(axis=1) / available
+    x = np.where(missing, mean[:, None], x)
+    x[available == 0] = 0.0
+    fit = ~np.isnan(y)
+    x_fit = np.where(fit[:, None], x, 0.0)
+    y_fit = np.where(fit, y, 0.0)
+    daily = np.zeros((len(starts), k * k + k))
+    for i in range(k):
+        for j in range(i, k):
+            daily[:, i * k + j] = np.add.reduceat(
+                x_fit[:, i] * x_fit[:, j], starts
+            )
+            daily[:, j * k + i] = daily[:, i * k + j]
+        daily[:, k * k + i] = np.add.reduceat(x_fit[:, i] * y_fit, starts)
+    weights = ensemble_weights(group_key, daily, k, days)
+
+    group = np.repeat(
+        np.arange(len(starts)), np.diff(np.append(starts, rows_count))
+    )
+    blend = np.empty(rows_count, dtype=dtype)
+    blend[order] = np.where(
+        available > 0, np.einsum("rk,rk->r", x, weights[group]), np.nan
+    )
+    return pd.Series(blend, index=dataframe.index)
+
+
+# Расчет на встроенной колоночной СУБД duckdb (backend: duckdb)
+# Тот же расчет, что у pandas: склейка факта с прогнозами провайдеров
+# по (gtp, dt), среднее, максимум и ансамбль, статистики по (дата, гтп)
+# и по (период, гтп, час). Прогнозы читаются из parquet кэша прямо
+# в duckdb, почасовая таблица всей истории в pandas не собирается,
+# в pandas приходят только дневные X'X и X'y для весов ансамбля
+# (ensemble_weights) и готовые статистики. duckdb считает на
+# DUCKDB_THREADS ядрах и при нехватке DUCKDB_MEMORY_LIMIT сбрасывает
+# промежуточные данные в DUCKDB_TEMP. Почасовая таблица в parquet/csv
+# выгружается из duckdb сразу в файл.
+# Возвращает statistics, hour_statistics и покрытие coverage как у pandas
+
+
+def duckdb_statistics(fact, load_from, date_from, month_from):
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("backend duckdb: не установлен пакет duckdb")
+    value_type = "FLOAT" if COMPACT else "DOUBLE"
+    provider_columns = [f"value_{provider}" for provider in PROVIDERS]
+    config = {"threads": DUCKDB_THREADS, "temp_directory": DUCKDB_TEMP}
+    if DUCKDB_MEMORY_LIMIT:
+        config["memory_limit"] = DUCKDB_MEMORY_LIMIT
+    connection_duckdb = duckdb.connect(config=config)
+    try:
+        connection_duckdb.register("fact_frame", fact)
+
+        # склейка с прогнозами провайдеров (нет прогноза - NULL) и среднее
+        # провайдеров, у которых есть прогноз на этот час
+        forecast_joins = []
+        for number, provider in enumerate(PROVIDERS):
+            partitions = [
+                str(partition).replace("'", "''")
+                for partition in forecast_cache_partitions(
+                    FORECAST_CACHE, provider
+                )
+                if partition.stem >= f"{load_from:%Y-%m}"
+            ]
+            if partitions:
+                files_sql = ", ".join(f"'{path}'" for path in partitions)
+                forecast_sql = (
+                    "SELECT CAST(gtp AS VARCHAR) AS gtp, dt, value FROM"
+                    f" read_parquet([{files_sql}]) WHERE dt >= $load_from"
+                )
+            else:
+                forecast_sql = (
+                    "SELECT NULL::VARCHAR AS gtp, NULL::TIMESTAMP AS dt,"
+                    " NULL::DOUBLE AS value WHERE false"
+                )
+            forecast_joins.append(
+                f" LEFT JOIN ({forecast_sql}) p{number} ON p{number}.gtp ="
+                f" f.gtp AND p{number}.dt = f.dt"
+            )
+        values_sql = ", ".join(
+            f"CAST(p{number}.value AS {value_type}) AS {column}"
+            for number, column in enumerate(provider_columns)
+        )
+        aver_sql = (
+            "("
+            + " + ".join(
+                f"COALESCE({column}, 0)" for column in provider_columns
+            )
+            + ") / NULLIF("
+            + " + ".join(
+                f"CAST({column} IS NOT NULL AS INTEGER)"
+                for column in provider_columns
+            )
+            + ", 0)"
+        )
+        connection_duckdb.execute(
+            f"CREATE TEMP TABLE predicts_base AS SELECT *, ({aver_sql}) AS"
+            " value_aver FROM (SELECT f.*, date_diff('day', DATE"
+            f" '1970-01-01', CAST(f.dt AS DATE)) AS day, {values_sql} FROM"
+            " (SELECT * REPLACE (CAST(gtp AS VARCHAR) AS gtp, CAST(fact AS"
+            f" {value_type}) AS fact) FROM fact_frame) f"
+            f"{''.join(forecast_joins)});",
+            {"load_from": pd.Timestamp(load_from)},
+        )
+        connection_duckdb.unregister("fact_frame")
+
+        # веса ансамбля по дневным X'X и X'y, пропуск провайдера
+        # заменяется средним, час без прогнозов - нулями, час без факта
+        # в подбор не входит (как в ensemble_predict)
+        k = len(provider_columns)
+        x_sql = [
+            f"CAST(COALESCE({column}, value_aver, 0) AS DOUBLE)"
+            for column in provider_columns
+        ]
+        fit_sql = "FILTER (WHERE fact IS NOT NULL), 0)"
+        daily_sql = ", ".join(
+            [
+                f"COALESCE(SUM({x_i} * {x_j}) {fit_sql}"
+                for x_i in x_sql
+                for x_j in x_sql
+            ]
+            + [f"COALESCE(SUM({x_i} * fact) {fit_sql}" for x_i in x_sql]
+        )
+        daily = connection_duckdb.execute(
+            f"SELECT gtp, day, {daily_sql} FROM predicts_base GROUP BY gtp,"
+            " day;"
+        ).df()
+        group_key = (
+            pd.factorize(daily["gtp"], sort=True)[0].astype("int64") * 2**20
+            + daily["day"].to_numpy(dtype="int64")
+        )
+        order = np.argsort(group_key, kind="stable")
+        weights = ensemble_weights(
+            group_key[order],
+            daily.iloc[order, 2:].to_numpy(dtype="float64"),
+            k,
+            ENSEMBLE_DAYS,
+        )
+        weights_frame = pd.DataFrame(
+            weights, columns=[f"w_{number}" for number in range(k)]
+        )
+        weights_frame.insert(0, "day", daily["day"].to_numpy()[order])
+        weights_frame.insert(0, "gtp", daily["gtp"].to_numpy()[order])
+        connection_duckdb.register("weights_frame", weights_frame)
+
+        # почасовая таблица окна расчета
+        blend_sql = " + ".join(
+            f"w.w_{number} * COALESCE(b.{column}, b.value_aver)"
+            for number, column in enumerate(provider_columns)
+        )
+        connection_duckdb.execute(
+            "CREATE TEMP TABLE predicts AS SELECT b.* EXCLUDE (day),"
+            f" GREATEST({', '.join(provider_columns)}) AS value_max,"
+            f" CAST({blend_sql} AS {value_type}) AS value_blend"
+            " FROM predicts_base b JOIN weights_frame w ON w.gtp = b.gtp AND"
+            " w.day = b.day WHERE b.dt >= $date_from;",
+            {"date_from": pd.Timestamp(date_from)},
+        )
+        connection_duckdb.unregister("weights_frame")
+        connection_duckdb.execute("DROP TABLE predicts_base;")
+
+        # выгрузка почасовой таблицы вместе с ошибками моделей по модулю
+        errors_sql = ", ".join(
+            f'ABS(fact - value_{provider}) AS "{provider}"'
+            for provider in PROVIDERS
+        )
+        predicts_sql = (
+            f"SELECT *, {errors_sql} FROM predicts ORDER BY gtp, dt"
+        )
+        output_format = OUTPUTS["model_predicts"]
+        if output_format in ["parquet", "csv"]:
+            if OUTPUT_DIR:
+                os.makedirs(OUTPUT_DIR, exist_ok=True)
+            path = os.path.join(
+                OUTPUT_DIR, f"{OUTPUT_FILES['model_predicts']}.{output_format}"
+            )
+            copy_format = (
+                "FORMAT PARQUET"
+                if output_format == "parquet"
+                else "FORMAT CSV, HEADER"
+            )
+            connection_duckdb.execute(
+                f"COPY ({predicts_sql}) TO '{path}' ({copy_format});"
+            )
+            logging.info(f"Выгрузка {path} записана.")
+        elif output_format != "off":
+            output_write(
+                connection_duckdb.execute(f"{predicts_sql};").df(),
+                "model_predicts",
+            )
+
+        # длинная таблица моделей законченных дней
+        # (сегодняшний день не закончился и в статистики не попадает)
+        connection_duckdb.execute(
+            "CREATE TEMP VIEW predicts_hours AS "
+            + " UNION ALL ".join(
+                "SELECT gtp, dt, CAST(fact AS DOUBLE) AS y,"
+                f" CAST({column} AS DOUBLE) AS p, '{model}' AS model FROM"
+                f" predicts WHERE dt < DATE '{today}'"
+                for model, column in MODELS.items()
+            )
+            + ";"
+        )
+        # покрытие дней гтп прогнозами моделей (как в score_coverage),
+        # прогнозы дней с покрытием ниже COVERAGE_MIN не считаются
+        connection_duckdb.execute(
+            "CREATE TEMP TABLE coverage AS SELECT *, COALESCE(coverage <"
+            " $coverage_min, false) AS skipped FROM (SELECT *, valid_hours /"
+            " NULLIF(hours, 0) AS coverage FROM (SELECT gtp, CAST(dt AS DATE)"
+            " AS date, model, COUNT(y) AS hours, COUNT(CASE WHEN y IS NOT"
+            " NULL THEN p END) AS valid_hours FROM predicts_hours GROUP BY"
+            " gtp, date, model));",
+            {"coverage_min": COVERAGE_MIN},
+        )
+        connection_duckdb.execute(
+            "CREATE TEMP VIEW predicts_long AS SELECT h.gtp, h.dt, h.y, CASE"
+            " WHEN c.skipped THEN NULL ELSE h.p END AS p, h.model FROM"
+            " predicts_hours h JOIN coverage c ON c.gtp = h.gtp AND c.date ="
+            " CAST(h.dt AS DATE) AND c.model = h.model;"
+        )
+        coverage = connection_duckdb.execute(
+            "SELECT gtp, date, model, hours, valid_hours, coverage, skipped"
+            " FROM coverage ORDER BY model, gtp, date;"
+        ).df()
+        day_sql = "CAST(dt AS DATE)"
+        month_sql = "CAST(date_trunc('month', dt) AS DATE)"
+        statistics = duckdb_group_statistics(
+            connection_duckdb, {"gtp": "gtp", "date": day_sql}
+        )
+        hour_statistics = duckdb_group_statistics(
+            connection_duckdb,
+            {
+                "gtp": "gtp",
+                "period": (
+                    f"CASE WHEN {day_sql} >= DATE '{month_from:%Y-%m-%d}'"
+                    f" THEN {day_sql} ELSE {month_sql} END"
+                ),
+                "hour": "CAST(hour(dt) AS INTEGER)",
+            },
+        )
+    finally:
+        connection_duckdb.close()
+    statistics["date"] = statistics["date"].dt.strftime("%Y-%m-%d")
+    hour_statistics["period"] = hour_statistics["period"].dt.strftime(
+        "%Y-%m-%d"
+    )
+    coverage["date"] = coverage["date"].dt.strftime("%Y-%m-%d")
+    return statistics, hour_statistics, coverage
+
+
+# Функция достаточных статистик моделей по группам keys
+# (столбец результата -> выражение SQL над predicts_long), столбцы
+# и смысл как у score_statistics: только часы с фактом и прогнозом
+# модели, ss_tot - по отклонениям от среднего группы, постоянный факт
+# в группе дает ss_tot = 0
+
+
+def duckdb_group_statistics(connection_duckdb, keys):
+    keys_sql = ", ".join(f"{sql} AS {key}" for key, sql in keys.items())
+    group_sql = ", ".join(list(keys) + ["model"])
+    return connection_duckdb.execute(
+        f"SELECT {group_sql}, COUNT(*) AS n, SUM(y) AS sum_y, SUM(y * y) AS"
+        " sum_y2, SUM(p) AS sum_p, SUM(p * p) AS sum_p2, SUM(y * p) AS"
+        " sum_yp, SUM((p - y) * (p - y)) AS sum_e2, SUM(ABS(p - y)) AS"
+        " sum_abs_e, CASE WHEN MIN(y) = MAX(y) THEN 0 ELSE SUM((y - mean_y)"
+        " * (y - mean_y)) END AS ss_tot, MAX(y) AS max_y FROM (SELECT *,"
+        f" AVG(y) OVER (PARTITION BY {group_sql}) AS mean_y FROM (SELECT"
+        f" {keys_sql}, model, y, p FROM predicts_long WHERE y IS NOT NULL"
+        f" AND p IS NOT NULL)) GROUP BY {group_sql};"
+    ).df()
+
+
+# Бенчмарк склейки: forecast_align против прежней цепочки merge
+# на синтетических данных размера gtp_count x days_count x 24 часа,
+# у каждого провайдера пропущено 5% часов. Печатает лучшее время
+# из repeats запусков и пиковую память (tracemalloc) каждого варианта
 
-# база из которой грузить модели (архив или основная на 40 дней)
-WORKING_DB_ARCHIVE = "treid_03.weather_foreca_archive"
-WORKING_DB = "treid_03.weather_foreca"
 
-# Общий раздел
+def join_benchmark(gtp_count, days_count, repeats=3):
+    rng = np.random.default_rng(0)
+    dt = pd.date_range(someday, periods=days_count * 24, freq="h")
+    gtp = [f"GVIE{number:04d}" for number in range(gtp_count)]
+    fact = pd.DataFrame(
+        {
+            "gtp": pd.Categorical(np.repeat(gtp, len(dt))),
+            "dt": np.tile(dt.to_numpy(), gtp_count),
+        }
+    )
+    fact["fact"] = rng.random(len(fact))
+    fact["date"] = fact["dt"].astype("str").str[0:-9]
+    fact["hour"] = fact["dt"].astype("str").str[-8:-6]
+    forecast_dataframes = {}
+    for provider in PROVIDERS:
+        forecast_dataframe = fact.loc[
+            rng.random(len(fact)) > 0.05, ["gtp", "dt"]
+        ].copy()
+        forecast_dataframe["load_time"] = forecast_dataframe[
+            "dt"
+        ].dt.normalize() - pd.Timedelta(hours=14)
+        forecast_dataframe["value"] = rng.random(len(forecast_dataframe))
+        forecast_dataframes[provider] = forecast_dataframe.reset_index(
+            drop=True
+        )
 
-# Настройки для логера
-if platform == "linux" or platform == "linux2":
-    logging.basicConfig(
-        filename="/var/log/log-execute/model_accuracy.log.txt",
-        level=logging.INFO,
-        format=(
-            "%(asctime)s - %(levelname)s - "
-            "%(funcName)s: %(lineno)d - %(message)s"
-        ),
+    def merge_chain():
+        temp_dataframe = fact
+        for provider, forecast_dataframe in forecast_dataframes.items():
+            temp_dataframe = temp_dataframe.merge(
+                forecast_dataframe.rename(
+                    columns=lambda column: f"{column}_{provider}"
+                ),
+                left_on=["gtp", "dt"],
+                right_on=[f"gtp_{provider}", f"dt_{provider}"],
+                how="left",
+            )
+        return temp_dataframe.drop(
+            [
+                f"{column}_{provider}"
+                for provider in PROVIDERS
+                for column in ["gtp", "dt", "load_time"]
+            ],
+            axis="columns",
+        )
+
+    def align():
+        return pd.concat(
+            [fact, forecast_align(fact, forecast_dataframes)], axis=1
+        )
+
+    print(
+        f"Склейка: {gtp_count} гтп x {days_count} дней ="
+        f" {len(fact)} строк факта, {len(PROVIDERS)} провайдеров"
     )
-elif platform == "win32":
-    logging.basicConfig(
-        filename=(
-            f"{pathlib.Path(__file__).parent.absolute()}"
-            "/model_accuracy.log.txt"
-        ),
-        level=logging.INFO,
-        format=(
-            "%(asctime)s - %(levelname)s - "
-            "%(funcName)s: %(lineno)d - %(message)s"
-        ),
+    results = {}
+    for name, join in [("merge", merge_chain), ("align", align)]:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            results[name] = join()
+            timings.append(time.perf_counter() - start)
+        results[name] = None
+        tracemalloc.start()
+        results[name] = join()
+        memory_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{name}: {min(timings):.3f} с (лучшее из {repeats}),"
+            f" пиковая память {memory_peak / 2**20:.0f} МБ"
+        )
+    value_columns = [f"value_{provider}" for provider in PROVIDERS]
+    assert np.allclose(
+        results["merge"][value_columns].to_numpy(dtype="float64"),
+        results["align"][value_columns].to_numpy(dtype="float64"),
+        equal_nan=True,
     )
 
-# Загружаем yaml файл с настройками
-with open(
-    f"{pathlib.Path(__file__).parent.absolute()}/settings.yaml", "r"
-) as yaml_file:
-    settings = yaml.safe_load(yaml_file)
-telegram_settings = pd.DataFrame(settings["telegram"])
-sql_settings = pd.DataFrame(settings["sql_db"])
-pyodbc_settings = pd.DataFrame(settings["pyodbc_db"])
-postgresql_settings = pd.DataFrame(settings["postgresql_db"])
-
-# Функция отправки уведомлений в telegram на любое количество каналов
-# (указать данные в yaml файле настроек)
 
+# Генератор синтетических данных в виде строк, которые отдают базы:
+# факт (gtp, DT, Val) и прогнозы всех провайдеров (gtp, dt, load_time,
+# id_foreca, value). Факт - солнечная выработка: дневной профиль
+# по часам, облачность дня и шум, масштаб - мощность гтп. Прогноз
+# провайдера - факт со своим смещением и шумом, загружен накануне
+# в 10 часов; у факта и каждого провайдера пропущено missing_rate
+# часов. При одном seed данные всегда одинаковые
 
-def telegram(i, text):
-    msg = urllib.parse.quote(str(text))
-    bot_token = str(telegram_settings.bot_token[i])
-    channel_id = str(telegram_settings.channel_id[i])
 
-    retry_strategy = Retry(
-        total=3,
-        status_forcelist=[101, 429, 500, 502, 503, 504],
-        method_whitelist=["GET", "POST"],
-        backoff_factor=1,
+def synthetic_data(gtp_count, days_count, missing_rate=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    dt = pd.date_range(someday, periods=days_count * 24, freq="h")
+    gtp = np.array(
+        [f"GVIE{number:04d}" for number in range(gtp_count)], dtype=object
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
-    http.mount("http://", adapter)
+    capacity = rng.uniform(5, 100, gtp_count)
+    profile = np.clip(np.sin(np.pi * (dt.hour.to_numpy() - 5) / 14), 0, None)
+    cloudiness = rng.beta(2, 1, (gtp_count, days_count)).repeat(24, axis=1)
+    fact_value = capacity[:, None] * profile * cloudiness
+    fact_value *= rng.normal(1, 0.05, fact_value.shape).clip(0)
+    fact_dt = np.tile(dt.to_numpy(dtype="datetime64[us]"), gtp_count)
+    fact_gtp = np.repeat(gtp, len(dt))
+    fact_value = fact_value.ravel()
+    present = rng.random(len(fact_value)) >= missing_rate
+    fact = {
+        "gtp": fact_gtp[present],
+        "DT": fact_dt[present],
+        "Val": fact_value[present],
+    }
 
-    http.post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage?chat_id={channel_id}&text={msg}",
-        timeout=10,
-    )
+    forecast_parts = []
+    for number, id_foreca in enumerate(PROVIDERS.values()):
+        bias = rng.normal(1, 0.1)
+        noise = 0.05 + 0.03 * number
+        present = rng.random(len(fact_value)) >= missing_rate
+        value = fact_value[present] * bias + rng.normal(
+            0, noise, present.sum()
+        ) * np.repeat(capacity, len(dt))[present]
+        forecast_dt = fact_dt[present]
+        forecast_parts.append(
+            {
+                "gtp": fact_gtp[present],
+                "dt": forecast_dt,
+                "load_time": forecast_dt.astype("datetime64[D]")
+                - np.timedelta64(14, "h"),
+                "id_foreca": np.full(present.sum(), id_foreca),
+                "value": np.clip(value, 0, None),
+            }
+        )
+    forecast = {
+        column: np.concatenate([part[column] for part in forecast_parts])
+        for column in forecast_parts[0]
+    }
+    return fact, forecast
 
 
-# Функция коннекта к базе Mysql
-# (для выбора базы задать порядковый номер числом !!! начинается с 0 !!!!!)
+# Заглушка курсора базы для бенчмарка: отдает столбцы columns
+# (имя -> numpy массив) строками-кортежами через fetchmany,
+# кортежи собираются только для запрошенной части, как у драйвера
 
 
-def connection(i):
-    host_yaml = str(sql_settings.host[i])
-    user_yaml = str(sql_settings.user[i])
-    port_yaml = int(sql_settings.port[i])
-    password_yaml = str(sql_settings.password[i])
-    database_yaml = str(sql_settings.database[i])
-    return pymysql.connect(
-        host=host_yaml,
-        user=user_yaml,
-        port=port_yaml,
-        password=password_yaml,
-        database=database_yaml,
+class SyntheticCursor:
+    def __init__(self, columns):
+        self.columns = list(columns.values())
+        self.position = 0
+
+    def fetchmany(self, size):
+        start = self.position
+        self.position = min(start + size, len(self.columns[0]))
+        return list(
+            zip(
+                *[
+                    values[start : self.position].tolist()
+                    for values in self.columns
+                ]
+            )
+        )
+
+
+# Бенчмарк всего расчета на синтетических данных без обращения к базам
+# Этапы: load (чтение строк курсора через fetch_typed), join (раскладка
+# по провайдерам и склейка с фактом), ensemble, scoring (дневные
+# и почасовые статистики и метрики), summary (итоговые таблицы r2
+# и сводные таблицы точности), output (выгрузки во временный каталог).
+# Время каждого этапа - лучшее из repeats прогонов, пиковая память
+# этапа (tracemalloc) - отдельным прогоном. Результат печатается и,
+# если задан report, дописывается строкой json в report для сравнения
+# запусков между собой
+
+
+def pipeline_benchmark(
+    gtp_count, days_count, missing_rate=0.05, repeats=3, report=None
+):
+    fact_rows, forecast_rows = synthetic_data(
+        gtp_count, days_count, missing_rate
     )
+    provider_columns = [f"value_{provider}" for provider in PROVIDERS]
 
+    def load(state):
+        state["fact"] = fact_prepare(
+            fetch_typed(
+                SyntheticCursor(fact_rows),
+                {
+                    "gtp": "category",
+                    "dt": "datetime64[ns]",
+                    "fact": VALUE_DTYPE,
+                },
+                FETCH_CHUNK,
+            )
+        )
+        state["forecast"] = fetch_typed(
+            SyntheticCursor(forecast_rows),
+            {
+                "gtp": "category",
+                "dt": "datetime64[ns]",
+                "load_time": "datetime64[ns]",
+                "id_foreca": "int16",
+                "value": "float64",
+            },
+            FETCH_CHUNK,
+        )
 
-# Конец Общего раздела
+    def join(state):
+        forecast = state["forecast"]
+        forecast_dataframes = {
+            provider: forecast.loc[
+                forecast["id_foreca"] == id_foreca,
+                ["gtp", "dt", "load_time", "value"],
+            ]
+            for provider, id_foreca in PROVIDERS.items()
+        }
+        state["predicts"] = model_predicts(state["fact"], forecast_dataframes)
 
+    def ensemble(state):
+        predicts = state["predicts"]
+        predicts["value_blend"] = ensemble_predict(
+            predicts, provider_columns, ENSEMBLE_DAYS, VALUE_DTYPE
+        )
+
+    def scoring(state):
+        # покрытие маскирует прогнозы в копии таблицы, как в run_stages
+        # (почасовая таблица выгружается без маски)
+        predicts = state["predicts"].copy(deep=False)
+        date = predicts["dt"].dt.normalize()
+        coverage = score_coverage(
+            predicts,
+            MODELS,
+            {"gtp": predicts["gtp"], "date": date},
+            COVERAGE_MIN,
+        )
+        coverage["date"] = coverage["date"].dt.strftime("%Y-%m-%d")
+        state["coverage"] = coverage
+        statistics = score_statistics_parallel(
+            predicts,
+            MODELS,
+            {"gtp": predicts["gtp"], "date": date},
+            SCORE_WORKERS,
+        )
+        statistics["date"] = statistics["date"].dt.strftime("%Y-%m-%d")
+        state["hour_statistics"] = score_statistics_parallel(
+            predicts,
+            MODELS,
+            {"gtp": predicts["gtp"], "hour": predicts["dt"].dt.hour},
+            SCORE_WORKERS,
+        )
+        state["statistics"] = statistics
+        state["metrics"] = score_metrics(statistics, ["date", "gtp", "model"])
+
+    def summary(state):
+        statistics = state["statistics"]
+        state["r2_score"], state["r2_score_by_gtp"] = r2_summary(
+            state["metrics"]
+        )
+        statistics = statistics.assign(month=statistics["date"].str[:7])
+        state["rollup_month"] = score_metrics(
+            statistics_combine(statistics, ["month", "gtp", "model"]),
+            ["month", "gtp", "model"],
+        )
+        state["rollup_hour"] = score_metrics(
+            state["hour_statistics"], ["gtp", "model", "hour"]
+        )
+        state["rollup_rolling"] = score_metrics(
+            statistics_rolling(state["statistics"], ROLLING_WINDOWS),
+            ["date", "gtp", "model", "window"],
+        )
+
+    def output(state):
+        with tempfile.TemporaryDirectory() as directory:
+            model_predicts_write(state["predicts"], directory)
+            for name in [
+                "metrics",
+                "rollup_month",
+                "rollup_hour",
+                "rollup_rolling",
+                "r2_score",
+                "r2_score_by_gtp",
+                "coverage",
+            ]:
+                output_write(state[name], name, directory)
+
+    stages = [load, join, ensemble, scoring, summary, output]
+    timings = {stage.__name__: [] for stage in stages}
+    for _ in range(repeats):
+        state = {}
+        for stage in stages:
+            start = time.perf_counter()
+            stage(state)
+            timings[stage.__name__].append(time.perf_counter() - start)
+    state = {}
+    memory_peaks = {}
+    tracemalloc.start()
+    for stage in stages:
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        stage(state)
+        memory_peaks[stage.__name__] = (
+            tracemalloc.get_traced_memory()[1] - memory_before
+        )
+    tracemalloc.stop()
+
+    result = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "gtp": gtp_count,
+        "days": days_count,
+        "missing_rate": missing_rate,
+        "rows": len(state["predicts"]),
+        "compact": COMPACT,
+        "stages": {
+            name: {
+                "seconds": round(min(timings[name]), 4),
+                "peak_mb": round(memory_peaks[name] / 2**20, 1),
+            }
+            for name in timings
+        },
+    }
+    print(
+        f"Расчет: {gtp_count} гтп x {days_count} дней ="
+        f" {result['rows']} строк, пропусков {missing_rate:.0%}"
+    )
+    for name, stage_result in result["stages"].items():
+        print(
+            f"{name:>10}: {stage_result['seconds']:8.3f} с (лучшее из"
+            f" {repeats}), пиковая память {stage_result['peak_mb']:.0f} МБ"
+        )
+    if report:
+        with open(report, "a") as report_file:
+            report_file.write(json.dumps(result) + "\n")
+    return result
 
-# Замер времени выполнения начало
-start_time = datetime.datetime.now()
-print(start_time)
-logging.info("Старт. Расчет точности моделей.")
 
-# Функция загрузки факта выработки
+# Функция коннекта к базе MSSQL с фактом
 # (для выбора базы задать порядковый номер числом !!! начинается с 0 !!!!!)
 
 
-def fact_load(i, dt):
+def connection_fact(i):
+    import pyodbc
+
     server = str(pyodbc_settings.host[i])
     database = str(pyodbc_settings.database[i])
     username = str(pyodbc_settings.user[i])
@@ -154,617 +2772,954 @@ def fact_load(i, dt):
             + ";PWD="
             + password
         )
-    #
+    # ограничение времени запроса (0 - без ограничения)
+    connection_ms.timeout = int(QUERY_TIMEOUT or 0)
+    return connection_ms
+
+
+# Код гтп из названия точки учета MSSQL
+FACT_GTP_SQL = "SUBSTRING(Points.PointName, len(Points.PointName)-8, 8)"
+
+# Функция условий запроса факта: выработка гтп с DT >= dt_from,
+# ГТП из EXCLUDED_GTP отсекаются одним NOT IN по коду гтп,
+# для частичного пересчета - до dt_to и только гтп из списка gtp.
+# Возвращает текст от FROM до конца WHERE и параметры запроса
+
+
+def fact_filter(dt_from, dt_to=None, gtp=None):
+    filter_sql = ""
+    parameters = [dt_from]
+    if dt_to is not None:
+        filter_sql += " AND DT < ?"
+        parameters.append(dt_to)
+    if gtp:
+        filter_sql += (
+            f" AND {FACT_GTP_SQL} IN ({', '.join(['?'] * len(gtp))})"
+        )
+        parameters.extend(gtp)
+    excluded_gtp = sorted(EXCLUDED_GTP)
+    if excluded_gtp:
+        filter_sql += (
+            f" AND {FACT_GTP_SQL} NOT IN"
+            f" ({', '.join(['?'] * len(excluded_gtp))})"
+        )
+        parameters.extend(excluded_gtp)
+    return (
+        "FROM Points JOIN PointParams ON"
+        " Points.ID_Point=PointParams.ID_Point JOIN PointMains ON"
+        " PointParams.ID_PP=PointMains.ID_PP WHERE PointName like"
+        " 'Генерация%{G%' AND ID_Param=153 AND DT >= ?"
+        f"{filter_sql}",
+        parameters,
+    )
+
+
+# Функция загрузки факта выработки по часам начиная с dt_from
+# (для выбора базы задать порядковый номер числом !!! начинается с 0 !!!!!)
+
+
+def fact_load(i, dt_from, dt_to=None, gtp=None):
+    connection_ms = connection_fact(i)
     mssql_cursor = connection_ms.cursor()
+    hour_sql = "DATEADD(HOUR, DATEDIFF(HOUR, 0, DT), 0)"
+    filter_sql, parameters = fact_filter(dt_from, dt_to, gtp)
     mssql_cursor.execute(
-        "SELECT SUBSTRING (Points.PointName ,"
-        "len(Points.PointName)-8, 8) as gtp, MIN(DT) as DT,"
-        " SUM(Val) as Val FROM Points JOIN PointParams ON "
-        "Points.ID_Point=PointParams.ID_Point JOIN PointMains"
-        " ON PointParams.ID_PP=PointMains.ID_PP WHERE "
-        "PointName like 'Генерация%{G%' AND ID_Param=153 "
-        "AND DT >= "
-        + str(dt)
-        + " AND PointName NOT LIKE "
-        "'%GVIE0001%' AND PointName NOT LIKE '%GVIE0012%' "
-        "AND PointName NOT LIKE '%GVIE0416%' AND PointName "
-        "NOT LIKE '%GVIE0167%' AND PointName NOT LIKE "
-        "'%GVIE0264%' AND PointName NOT LIKE '%GVIE0007%' "
-        "AND PointName NOT LIKE '%GVIE0680%' AND PointName "
-        "NOT LIKE '%GVIE0987%' AND PointName NOT LIKE "
-        "'%GVIE0988%' AND PointName NOT LIKE '%GVIE0989%' "
-        "AND PointName NOT LIKE '%GVIE0991%' AND PointName "
-        "NOT LIKE '%GVIE0992%' AND PointName NOT LIKE "
-        "'%GVIE0993%' AND PointName NOT LIKE '%GVIE0994%' "
-        "AND PointName NOT LIKE '%GVIE1372%' "
-        "GROUP BY SUBSTRING (Points.PointName "
-        ",len(Points.PointName)-8, 8), DATEPART(YEAR, DT), "
-        "DATEPART(MONTH, DT), DATEPART(DAY, DT), "
-        "DATEPART(HOUR, DT) ORDER BY SUBSTRING "
-        "(Points.PointName ,len(Points.PointName)-8, 8), "
-        "DATEPART(YEAR, DT), DATEPART(MONTH, DT), "
-        "DATEPART(DAY, DT), DATEPART(HOUR, DT);"
-    )
-    fact = mssql_cursor.fetchall()
-    connection_ms.close()
-    fact = pd.DataFrame(np.array(fact), columns=["gtp", "dt", "fact"])
-    fact.drop_duplicates(
-        subset=["gtp", "dt"], keep="last", inplace=True, ignore_index=False
+        f"SELECT {FACT_GTP_SQL} as gtp, MIN(DT) as DT, SUM(Val) as Val"
+        f" {filter_sql} GROUP BY {FACT_GTP_SQL}, {hour_sql} ORDER BY"
+        f" {FACT_GTP_SQL}, {hour_sql};",
+        *parameters,
     )
-    fact["date"] = fact["dt"].astype("str").str[0:-9]
-    fact["hour"] = fact["dt"].astype("str").str[-8:-6]
-    return fact
+    fact = fetch_typed(
+        mssql_cursor,
+        {"gtp": "category", "dt": "datetime64[ns]", "fact": VALUE_DTYPE},
+        FETCH_CHUNK,
+    )
+    connection_ms.close()
+    return fact_prepare(fact)
 
 
-fact = fact_load(
-    0, f"DATEADD(HOUR, -{DAYS_COUNT} * 24, DATEDIFF(d, 0, GETDATE()))"
-)
+# Функция последнего DT факта начиная с dt_from (дешевый запрос
+# без группировки для проверки, появились ли новые строки),
+# нет строк - None
 
-# Загрузка прогнозов моделей
-logging.info("Старт. Загрузка прогнозов моделей.")
-connection_forecast = connection(0)
-with connection_forecast.cursor() as cursor:
-    # cblg
-    cblg_sql = (
-        "SELECT gtp, dt, load_time, value 'cblg' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 14 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(cblg_sql)
-    cblg_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=["gtp_cblg", "dt_cblg", "load_time_cblg", "value_cblg"],
-    )
-    cblg = (
-        f"SELECT gtp, dt, load_time, value 'cblg' FROM {WORKING_DB} WHERE"
-        " id_foreca = 14 AND (HOUR(load_time) < 15 AND DATE(load_time) ="
-        " DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt) between"
-        f" DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(cblg)
-    cblg_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=["gtp_cblg", "dt_cblg", "load_time_cblg", "value_cblg"],
-    )
-    cblg_dataframe = pd.concat([cblg_dataframe, cblg_df], axis=0)
-    cblg_dataframe.drop_duplicates(
-        subset=["gtp_cblg", "dt_cblg"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # wpgq
-    wpgq_sql = (
-        "SELECT gtp, dt, load_time, value 'wpgq' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 13 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(wpgq_sql)
-    wpgq_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=["gtp_wpgq", "dt_wpgq", "load_time_wpgq", "value_wpgq"],
-    )
-    wpgq = (
-        f"SELECT gtp, dt, load_time, value 'wpgq' FROM {WORKING_DB} WHERE"
-        " id_foreca = 13 AND (HOUR(load_time) < 15 AND DATE(load_time) ="
-        " DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt) between"
-        f" DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(wpgq)
-    wpgq_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=["gtp_wpgq", "dt_wpgq", "load_time_wpgq", "value_wpgq"],
-    )
-    wpgq_dataframe = pd.concat([wpgq_dataframe, wpgq_df], axis=0)
-    wpgq_dataframe.drop_duplicates(
-        subset=["gtp_wpgq", "dt_wpgq"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # rp5_1da
-    rp5_1da_sql = (
-        "SELECT gtp, dt, load_time, value 'rp5_1da' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 16 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(rp5_1da_sql)
-    rp5_1da_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_rp5_1da",
-            "dt_rp5_1da",
-            "load_time_rp5_1da",
-            "value_rp5_1da",
-        ],
-    )
-    rp5_1da = (
-        f"SELECT gtp, dt, load_time, value 'rp5_1da' FROM {WORKING_DB} WHERE"
-        " id_foreca = 16 AND (HOUR(load_time) < 15 AND DATE(load_time) ="
-        " DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt) between"
-        f" DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(rp5_1da)
-    rp5_1da_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_rp5_1da",
-            "dt_rp5_1da",
-            "load_time_rp5_1da",
-            "value_rp5_1da",
-        ],
+
+def fact_watermark(i, dt_from, gtp=None):
+    connection_ms = connection_fact(i)
+    try:
+        mssql_cursor = connection_ms.cursor()
+        filter_sql, parameters = fact_filter(dt_from, gtp=gtp)
+        mssql_cursor.execute(f"SELECT MAX(DT) {filter_sql};", *parameters)
+        row = mssql_cursor.fetchone()
+    finally:
+        connection_ms.close()
+    if row is None or row[0] is None:
+        return None
+    return pd.Timestamp(row[0])
+
+
+# Функция загрузки прогнозов всех провайдеров одним запросом к базе
+# (архивной или основной). Берется прогноз, загруженный накануне до 15 часов,
+# условия на dt и load_time - простые диапазоны без функций над dt слева,
+# чтобы работал range scan по индексу. load_time_from: провайдер ->
+# последний load_time в кэше, для провайдеров без кэша грузится вся история
+# с dt_from (по умолчанию someday), для остальных - только строки новее
+# кэша. Для частичного пересчета - до dt_to и только гтп из списка gtp.
+# load_minutes - другое окно load_time в минутах от начала суток dt
+# (от, до), для разбора по срезам времени загрузки, with_today - вместе
+# с прогнозом на сегодня (для расчета точности внутри дня).
+# Возвращает длинную таблицу gtp, dt, load_time, id_foreca, value
+
+
+def forecast_load(
+    cursor,
+    database,
+    load_time_from,
+    dt_from=None,
+    dt_to=None,
+    gtp=None,
+    load_minutes=None,
+    with_today=False,
+):
+    providers_new = [
+        PROVIDERS[provider]
+        for provider, watermark in load_time_from.items()
+        if watermark is None
+    ]
+    providers_cached = [
+        PROVIDERS[provider]
+        for provider, watermark in load_time_from.items()
+        if watermark is not None
+    ]
+    if providers_cached:
+        load_time_watermark = min(
+            watermark
+            for watermark in load_time_from.values()
+            if watermark is not None
+        )
+    dt_from = datetime.datetime.combine(dt_from or someday, datetime.time())
+    if not providers_new:
+        dt_from = max(
+            dt_from,
+            datetime.datetime.combine(
+                load_time_watermark.date(), datetime.time()
+            ),
+        )
+
+    filter_sql = "" if with_today else " AND dt < CURDATE()"
+    parameters = [dt_from]
+    if dt_to is not None:
+        filter_sql += " AND dt < %s"
+        parameters.append(dt_to)
+    if gtp:
+        filter_sql += f" AND gtp IN ({', '.join(['%s'] * len(gtp))})"
+        parameters.extend(gtp)
+    provider_conditions = []
+    if providers_new:
+        provider_conditions.append(
+            f"id_foreca IN ({', '.join(['%s'] * len(providers_new))})"
+        )
+        parameters.extend(providers_new)
+    if providers_cached:
+        provider_conditions.append(
+            f"(id_foreca IN ({', '.join(['%s'] * len(providers_cached))})"
+            " AND load_time > %s)"
+        )
+        parameters.extend(providers_cached)
+        parameters.append(load_time_watermark)
+    load_time_sql = (
+        "load_time >= DATE_SUB(DATE(dt), INTERVAL 1 DAY) AND load_time <"
+        " DATE_SUB(DATE(dt), INTERVAL 9 HOUR)"
     )
-    rp5_1da_dataframe = pd.concat([rp5_1da_dataframe, rp5_1da_df], axis=0)
-    rp5_1da_dataframe.drop_duplicates(
-        subset=["gtp_rp5_1da", "dt_rp5_1da"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # cbr_rp5
-    cbr_rp5_sql = (
-        "SELECT gtp, dt, load_time, value 'cbr_rp5' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 11 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(cbr_rp5_sql)
-    cbr_rp5_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_cbr_rp5",
-            "dt_cbr_rp5",
-            "load_time_cbr_rp5",
-            "value_cbr_rp5",
-        ],
+    if load_minutes is not None:
+        load_time_sql = (
+            "load_time >= DATE_ADD(DATE(dt), INTERVAL"
+            f" {int(load_minutes[0])} MINUTE) AND load_time <"
+            f" DATE_ADD(DATE(dt), INTERVAL {int(load_minutes[1])} MINUTE)"
+        )
+    forecast_sql = (
+        "SELECT gtp, dt, load_time, id_foreca, value FROM"
+        f" {database} WHERE dt >= %s{filter_sql} AND"
+        f" {load_time_sql} AND ({' OR '.join(provider_conditions)})"
+        " ORDER BY id_foreca, gtp, dt, load_time;"
     )
-    cbr_rp5 = (
-        f"SELECT gtp, dt, load_time, value 'cbr_rp5' FROM {WORKING_DB} WHERE"
-        " id_foreca = 11 AND (HOUR(load_time) < 15 AND DATE(load_time) ="
-        " DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt) between"
-        f" DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(cbr_rp5)
-    cbr_rp5_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_cbr_rp5",
-            "dt_cbr_rp5",
-            "load_time_cbr_rp5",
-            "value_cbr_rp5",
-        ],
+    cursor.execute(forecast_sql, parameters)
+    return fetch_typed(
+        cursor,
+        {
+            "gtp": "category",
+            "dt": "datetime64[ns]",
+            "load_time": "datetime64[ns]",
+            "id_foreca": "int16",
+            "value": "float64",
+        },
+        FETCH_CHUNK,
     )
-    cbr_rp5_dataframe = pd.concat([cbr_rp5_dataframe, cbr_rp5_df], axis=0)
-    cbr_rp5_dataframe.drop_duplicates(
-        subset=["gtp_cbr_rp5", "dt_cbr_rp5"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # visualcrossing
-    visualcrossing_sql = (
-        "SELECT gtp, dt, load_time, value 'visualcrossing' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 18 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(visualcrossing_sql)
-    visualcrossing_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_visualcrossing",
-            "dt_visualcrossing",
-            "load_time_visualcrossing",
-            "value_visualcrossing",
-        ],
+
+
+# Функция загрузки прогнозов из одной базы через отдельное соединение
+# (для параллельной загрузки у каждого потока свое соединение)
+
+
+def forecast_load_database(
+    database,
+    load_time_from,
+    dt_from=None,
+    dt_to=None,
+    gtp=None,
+    load_minutes=None,
+    with_today=False,
+):
+    import pymysql.cursors
+
+    connection_forecast = connection(0, QUERY_TIMEOUT)
+    try:
+        # курсор на стороне сервера, строки не копятся в клиенте целиком
+        with connection_forecast.cursor(pymysql.cursors.SSCursor) as cursor:
+            return forecast_load(
+                cursor,
+                database,
+                load_time_from,
+                dt_from,
+                dt_to,
+                gtp,
+                load_minutes,
+                with_today,
+            )
+    finally:
+        connection_forecast.close()
+
+
+# Функция выбора баз для загрузки прогнозов по диапазону дат:
+# основная база хранит последние WORKING_DB_DAYS дней, архив - то, что
+# старше. Архив читается только до границы основной базы, основная -
+# только после нее, дни на границе (WORKING_DB_OVERLAP_DAYS в каждую
+# сторону, пока строки переносятся в архив) читаются из обеих,
+# совпавшие строки отбрасываются при записи в кэш.
+# Возвращает список (база, dt_from, dt_to), dt_to None - до сегодня
+
+
+def forecast_routes(load_time_from, dt_from=None, dt_to=None):
+    dt_from = datetime.datetime.combine(dt_from or someday, datetime.time())
+    load_time_watermarks = list(load_time_from.values())
+    if load_time_watermarks and None not in load_time_watermarks:
+        # как в forecast_load: у всех провайдеров есть кэш, строки новее
+        # кэша не могут быть раньше его последнего дня
+        dt_from = max(
+            dt_from,
+            datetime.datetime.combine(
+                min(load_time_watermarks).date(), datetime.time()
+            ),
+        )
+    horizon = datetime.datetime.combine(
+        today - datetime.timedelta(days=WORKING_DB_DAYS), datetime.time()
     )
-    visualcrossing = (
-        "SELECT gtp, dt, load_time, value 'visualcrossing' FROM"
-        f" {WORKING_DB} WHERE id_foreca = 18 AND (HOUR(load_time) < 15 AND"
-        " DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt)"
-        f" between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(visualcrossing)
-    visualcrossing_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_visualcrossing",
-            "dt_visualcrossing",
-            "load_time_visualcrossing",
-            "value_visualcrossing",
-        ],
+    overlap = datetime.timedelta(days=WORKING_DB_OVERLAP_DAYS)
+    routes = []
+    archive_to = horizon + overlap
+    if dt_to is not None:
+        archive_to = min(archive_to, dt_to)
+    if dt_from < archive_to:
+        routes.append((WORKING_DB_ARCHIVE, dt_from, archive_to))
+    working_from = max(dt_from, horizon - overlap)
+    if dt_to is None or working_from < dt_to:
+        routes.append((WORKING_DB, working_from, dt_to))
+    if not routes:
+        # пустой диапазон: один запрос, который вернет пустую таблицу
+        routes.append((WORKING_DB, dt_from, dt_to))
+    return routes
+
+
+# Функции резидентного режима (--watch): точность моделей за сегодня
+# по законченным часам без перезапуска скрипта. При старте и смене суток
+# в память один раз грузятся история за ENSEMBLE_DAYS дней (факт из
+# базы, прогнозы из кэша основного расчета) для весов ансамбля
+# и прогнозы провайдеров на сегодня. Дальше каждые WATCH_INTERVAL секунд
+# дешевым запросом проверяется последний DT факта, и только когда он
+# ушел вперед, из базы берутся новые законченные часы (час закончен,
+# когда в базе есть факт позже его конца). Их статистики складываются
+# с накопленными за сегодня, метрики по гтп отдаются из памяти по http
+# (GET /intraday, /intraday?gtp=<гтп>).
+# Источники данных (watch_sources) подменяются для проверки без баз:
+# fact_watermark(dt_from), fact(dt_from, dt_to), forecast_today(day) -
+# длинная таблица как у forecast_load, forecast_history(date_from) -
+# провайдер -> прогнозы
+
+
+def watch_sources(gtp=None):
+    def fact_source(dt_from, dt_to):
+        return fact_load(0, dt_from, dt_to, gtp)
+
+    def fact_watermark_source(dt_from):
+        return fact_watermark(0, dt_from, gtp)
+
+    def forecast_today(day):
+        # прогнозы на сегодня есть только в основной базе
+        dt_from = datetime.datetime.combine(day, datetime.time())
+        return forecast_load_database(
+            WORKING_DB,
+            {provider: None for provider in PROVIDERS},
+            dt_from,
+            dt_from + datetime.timedelta(days=1),
+            gtp,
+            with_today=True,
+        )
+
+    def forecast_history(date_from):
+        forecast_dataframes = {}
+        for provider in PROVIDERS:
+            forecast_dataframe = forecast_cache_read(
+                FORECAST_CACHE, provider, date_from
+            )
+            if gtp:
+                forecast_dataframe = forecast_dataframe[
+                    forecast_dataframe["gtp"].isin(gtp)
+                ]
+            forecast_dataframes[provider] = forecast_dataframe
+        return forecast_dataframes
+
+    return {
+        "fact": fact_source,
+        "fact_watermark": fact_watermark_source,
+        "forecast_today": forecast_today,
+        "forecast_history": forecast_history,
+    }
+
+
+def watch_day(sources, day):
+    day_from = datetime.datetime.combine(day, datetime.time())
+    history_from = day_from - datetime.timedelta(days=ENSEMBLE_DAYS)
+    history = model_predicts(
+        sources["fact"](history_from, day_from),
+        sources["forecast_history"](history_from.date()),
     )
-    visualcrossing_dataframe = pd.concat(
-        [visualcrossing_dataframe, visualcrossing_df], axis=0
+    forecast_today = sources["forecast_today"](day)
+    # в базе лежат все версии прогноза, берется последняя, как в расчете
+    forecast_dataframes = {
+        provider: forecast_merge(
+            [
+                forecast_today.loc[
+                    forecast_today["id_foreca"] == id_foreca,
+                    ["gtp", "dt", "load_time", "value"],
+                ]
+            ]
+        )
+        for provider, id_foreca in PROVIDERS.items()
+    }
+    logging.info(
+        f"Точность за {day}: история {len(history)} строк, прогнозов на"
+        f" сегодня {len(forecast_today)} строк."
     )
-    visualcrossing_dataframe.drop_duplicates(
-        subset=["gtp_visualcrossing", "dt_visualcrossing"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # OpenMeteo
-    openmeteo_sql = (
-        "SELECT gtp, dt, load_time, value 'openmeteo' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 20 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(openmeteo_sql)
-    openmeteo_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_openmeteo",
-            "dt_openmeteo",
-            "load_time_openmeteo",
-            "value_openmeteo",
-        ],
+    return {
+        "day": day,
+        "history": history,
+        "forecasts": forecast_dataframes,
+        "watermark": None,
+        "closed_to": pd.Timestamp(day_from),
+        "statistics": None,
+        "metrics": pd.DataFrame(columns=["gtp", "model"]),
+        "updated": None,
+    }
+
+
+def watch_poll(state, sources):
+    watermark = sources["fact_watermark"](
+        state["closed_to"].to_pydatetime()
     )
-    openmeteo = (
-        f"SELECT gtp, dt, load_time, value 'openmeteo' FROM {WORKING_DB} WHERE"
-        " id_foreca = 20 AND (HOUR(load_time) < 15 AND DATE(load_time) ="
-        " DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt) between"
-        f" DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(openmeteo)
-    openmeteo_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_openmeteo",
-            "dt_openmeteo",
-            "load_time_openmeteo",
-            "value_openmeteo",
-        ],
+    if watermark is None or (
+        state["watermark"] is not None and watermark <= state["watermark"]
+    ):
+        return False
+    state["watermark"] = watermark
+    closed_to = watermark.floor("h")
+    if closed_to <= state["closed_to"]:
+        return False
+    fact = sources["fact"](
+        state["closed_to"].to_pydatetime(), closed_to.to_pydatetime()
     )
-    openmeteo_dataframe = pd.concat(
-        [openmeteo_dataframe, openmeteo_df], axis=0
+    state["closed_to"] = closed_to
+    if fact.empty:
+        return False
+
+    predicts = model_predicts(fact, state["forecasts"])
+    # веса ансамбля на сегодня зависят только от истории, новые часы
+    # просто добавляются к ней
+    predicts["value_blend"] = ensemble_predict(
+        pd.concat([state["history"], predicts], ignore_index=True),
+        [f"value_{provider}" for provider in PROVIDERS],
+        ENSEMBLE_DAYS,
+        VALUE_DTYPE,
+    ).to_numpy()[-len(predicts) :]
+    statistics = score_statistics(predicts, MODELS, {"gtp": predicts["gtp"]})
+    if state["statistics"] is not None:
+        statistics = statistics_combine(
+            pd.concat([state["statistics"], statistics], ignore_index=True),
+            ["gtp", "model"],
+        )
+    state["statistics"] = statistics
+    state["metrics"] = score_metrics(statistics, ["gtp", "model"]).assign(
+        hours=statistics["n"].to_numpy()
     )
-    openmeteo_dataframe.drop_duplicates(
-        subset=["gtp_openmeteo", "dt_openmeteo"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
-    )
-
-    # tomorrow_io
-    tomorrow_io_sql = (
-        "SELECT gtp, dt, load_time, value 'tomorrow_io' FROM"
-        f" {WORKING_DB_ARCHIVE} WHERE id_foreca = 22 AND (HOUR(load_time) < 15"
-        " AND DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND"
-        f" DATE(dt) between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY)"
-        " and DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(tomorrow_io_sql)
-    tomorrow_io_dataframe = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_tomorrow_io",
-            "dt_tomorrow_io",
-            "load_time_tomorrow_io",
-            "value_tomorrow_io",
-        ],
+    state["updated"] = datetime.datetime.now()
+    return True
+
+
+# Функция http сервера точности внутри дня в отдельном потоке:
+# отвечает json с метриками из state (по гтп из ?gtp= или по всем)
+
+
+def watch_serve(state, host, port):
+    import http.server
+    import urllib.parse
+
+    class IntradayHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/intraday":
+                self.send_error(404)
+                return
+            metrics = state.get("metrics")
+            if metrics is None:
+                metrics = pd.DataFrame(columns=["gtp", "model"])
+            gtp = urllib.parse.parse_qs(url.query).get("gtp")
+            if gtp:
+                metrics = metrics[metrics["gtp"].isin(gtp)]
+            body = json.dumps(
+                {
+                    "day": state.get("day"),
+                    "closed_to": state.get("closed_to"),
+                    "watermark": state.get("watermark"),
+                    "updated": state.get("updated"),
+                    "metrics": metrics.astype(object)
+                    .where(metrics.notna(), None)
+                    .to_dict("records"),
+                },
+                default=str,
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *message_args):
+            logging.debug(format % message_args)
+
+    server = http.server.ThreadingHTTPServer((host, port), IntradayHandler)
+    threading.Thread(
+        target=server.serve_forever, name="intraday", daemon=True
+    ).start()
+    return server
+
+
+# Цикл резидентного режима, polls - сколько проверок сделать
+# (None - до остановки процесса). Ошибка одной проверки (база
+# недоступна) пишется в лог, сервис продолжает работу
+
+
+def watch(args, sources=None, polls=None):
+    sources = sources or watch_sources(args.gtp)
+    state = {}
+    server = None
+    if WATCH_PORT:
+        server = watch_serve(state, WATCH_HOST, WATCH_PORT)
+    logging.info(
+        f"Старт. Точность внутри дня, проверка каждые {WATCH_INTERVAL} с,"
+        f" http порт {WATCH_PORT}."
     )
-    tomorrow_io = (
-        "SELECT gtp, dt, load_time, value 'tomorrow_io' FROM"
-        f" {WORKING_DB} WHERE id_foreca = 22 AND (HOUR(load_time) < 15 AND"
-        " DATE(load_time) = DATE_ADD(DATE(dt), INTERVAL -1 DAY)) AND DATE(dt)"
-        f" between DATE_ADD(CURDATE(), INTERVAL -{DAYS_COUNT} DAY) and"
-        " DATE_ADD(CURDATE(), INTERVAL -1 DAY) ORDER BY gtp, dt;"
-    )
-    cursor.execute(tomorrow_io)
-    tomorrow_io_df = pd.DataFrame(
-        cursor.fetchall(),
-        columns=[
-            "gtp_tomorrow_io",
-            "dt_tomorrow_io",
-            "load_time_tomorrow_io",
-            "value_tomorrow_io",
-        ],
+    poll = 0
+    try:
+        while polls is None or poll < polls:
+            day = datetime.datetime.now().date()
+            try:
+                if state.get("day") != day:
+                    state.update(watch_day(sources, day))
+                if watch_poll(state, sources):
+                    logging.info(
+                        f"Точность внутри дня обновлена по"
+                        f" {state['closed_to']}."
+                    )
+            except Exception:
+                logging.exception("Не удалось обновить точность внутри дня")
+            poll += 1
+            if polls is None or poll < polls:
+                time.sleep(WATCH_INTERVAL)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    return state
+
+
+# Конец Общего раздела
+
+
+# Расчет точности моделей: args из arguments, модуль настроен configure.
+# Отчет о запуске пишется при любом завершении расчета
+
+
+def run(args):
+    global today
+
+    # Замер времени выполнения начало
+    start_time = datetime.datetime.now()
+    print(start_time)
+    # в процессе, который живет дольше суток (планировщик), today
+    # должен быть датой запуска
+    today = start_time.date()
+    logging.info("Старт. Расчет точности моделей.")
+    report_start(args)
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        run_stages(args)
+    finally:
+        report_write(profiler, args.profile)
+
+    # Замер времени выполнения конец
+    end_time = datetime.datetime.now()
+    delta = end_time - start_time
+    print(end_time)
+    print(delta)
+
+
+# Этапы расчета точности по порядку: хранилище, загрузка, кэш, склейка
+# и статистики (pandas или duckdb), хранилище и итоговые таблицы
+
+
+def run_stages(args):
+    if args.vintages:
+        vintages_run(args)
+        run_report["status"] = "vintages"
+        return
+    report_stage("store")
+
+    # Инкрементальный режим: грузятся и считаются только дни после последнего
+    # сохраненного в хранилище дня и LOOKBACK_DAYS дней перед ним,
+    # при пустом хранилище или с ключом --full - вся история с someday
+    connection_store = score_store_connect(SCORE_STORE)
+    if args.rollups_only:
+        for name, rollup in score_rollups(connection_store).items():
+            output_write(rollup, name)
+        connection_store.close()
+        logging.info("Сводные таблицы точности посчитаны.")
+        run_report["status"] = "rollups_only"
+        return
+    watermark = (
+        None
+        if args.full or PARTIAL
+        else score_store_watermark(connection_store)
     )
-    tomorrow_io_dataframe = pd.concat(
-        [tomorrow_io_dataframe, tomorrow_io_df], axis=0
+    if PARTIAL:
+        date_from = args.date_from or someday
+    elif watermark is None:
+        date_from = someday
+    else:
+        date_from = max(
+            someday, watermark + datetime.timedelta(days=1 - LOOKBACK_DAYS)
+        )
+        # окно началось внутри уже свернутого по месяцам месяца
+        # почасовых статистик - месяц пересчитывается целиком
+        date_from = max(
+            someday, hour_store_date_from(connection_store, date_from)
+        )
+    # граница dt для частичного пересчета (не включая)
+    dt_to = None
+    if args.date_to:
+        dt_to = datetime.datetime.combine(
+            args.date_to + datetime.timedelta(days=1), datetime.time()
+        )
+    logging.info(
+        f"Расчет с {date_from}, последний день в хранилище: {watermark}."
     )
-    tomorrow_io_dataframe.drop_duplicates(
-        subset=["gtp_tomorrow_io", "dt_tomorrow_io"],
-        keep="last",
-        inplace=True,
-        ignore_index=False,
+    backend = BACKEND
+    if PARTIAL:
+        logging.info(
+            f"Частичный пересчет: по {args.date_to}, гтп {args.gtp},"
+            f" провайдеры {list(PROVIDERS)}."
+        )
+        # duckdb читает прогнозы из кэша, а новые строки частичного
+        # пересчета в кэш не пишутся
+        backend = "pandas"
+    # для подбора весов ансамбля нужны еще ENSEMBLE_DAYS дней до date_from
+    load_from = max(
+        someday, date_from - datetime.timedelta(days=ENSEMBLE_DAYS)
     )
 
-connection_forecast.close()
-logging.info("Прогнозы моделей загружены.")
-
-# Склеиваем факт и прогнозы моделей, считаем среднее и максимум всех
-logging.info("Старт. Склейка датафрейма для расчета.")
-temp_dataframe = fact.merge(
-    cblg_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_cblg", "dt_cblg"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    wpgq_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_wpgq", "dt_wpgq"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    rp5_1da_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_rp5_1da", "dt_rp5_1da"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    cbr_rp5_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_cbr_rp5", "dt_cbr_rp5"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    visualcrossing_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_visualcrossing", "dt_visualcrossing"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    openmeteo_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_openmeteo", "dt_openmeteo"],
-    how="left",
-)
-temp_dataframe = temp_dataframe.merge(
-    tomorrow_io_dataframe,
-    left_on=["gtp", "dt"],
-    right_on=["gtp_tomorrow_io", "dt_tomorrow_io"],
-    how="left",
-)
-temp_dataframe.fillna(0, inplace=True)
-temp_dataframe.drop(
-    [
-        "gtp_cblg",
-        "dt_cblg",
-        "load_time_cblg",
-        "gtp_wpgq",
-        "dt_wpgq",
-        "load_time_wpgq",
-        "gtp_rp5_1da",
-        "dt_rp5_1da",
-        "load_time_rp5_1da",
-        "gtp_cbr_rp5",
-        "dt_cbr_rp5",
-        "load_time_cbr_rp5",
-        "gtp_visualcrossing",
-        "dt_visualcrossing",
-        "load_time_visualcrossing",
-        "gtp_openmeteo",
-        "dt_openmeteo",
-        "load_time_openmeteo",
-        "gtp_tomorrow_io",
-        "dt_tomorrow_io",
-        "load_time_tomorrow_io",
-    ],
-    axis="columns",
-    inplace=True,
-)
-temp_dataframe["value_aver"] = temp_dataframe[
-    [
-        "value_cblg",
-        "value_wpgq",
-        "value_rp5_1da",
-        "value_cbr_rp5",
-        "value_visualcrossing",
-        "value_openmeteo",
-        "value_tomorrow_io",
-    ]
-].mean(axis=1)
-temp_dataframe["value_max"] = temp_dataframe[
-    [
-        "value_cblg",
-        "value_wpgq",
-        "value_rp5_1da",
-        "value_cbr_rp5",
-        "value_visualcrossing",
-        "value_openmeteo",
-        "value_tomorrow_io",
-    ]
-].max(axis=1)
+    # Загрузка факта и прогнозов моделей
+    # Прогнозы хранятся в локальном кэше (parquet по провайдеру и месяцу),
+    # из баз догружаются только строки с load_time новее последнего в кэше.
+    # Факт из MSSQL и прогнозы из обеих баз MySQL грузятся параллельно
+    # в пуле из LOAD_WORKERS потоков
+    logging.info("Старт. Загрузка факта и прогнозов моделей.")
+    report_stage("load")
+    load_time_from = {}
+    for provider in PROVIDERS:
+        if args.refresh:
+            forecast_cache_clear(FORECAST_CACHE, provider)
+        load_time_from[provider] = forecast_cache_watermark(
+            FORECAST_CACHE, provider
+        )
+        # окно раньше начала кэша (удаленные месяцы, кэш заполнялся
+        # с более позднего окна): провайдер грузится из баз целиком
+        cache_start = forecast_cache_start(FORECAST_CACHE, provider)
+        if cache_start is not None and cache_start.date() > load_from:
+            logging.info(
+                f"{provider}: кэш начинается с {cache_start}, прогнозы с"
+                f" {load_from} грузятся из баз."
+            )
+            load_time_from[provider] = None
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=LOAD_WORKERS
+    ) as executor:
+        fact_future = executor.submit(
+            report_timed,
+            "load_fact",
+            fact_load,
+            0,
+            datetime.datetime.combine(load_from, datetime.time()),
+            dt_to,
+            args.gtp,
+        )
+        forecast_futures = {}
+        for database, route_from, route_to in forecast_routes(
+            load_time_from, load_from, dt_to
+        ):
+            logging.info(f"{database}: dt с {route_from} до {route_to}.")
+            forecast_futures[database] = executor.submit(
+                report_timed,
+                f"load_{database}",
+                forecast_load_database,
+                database,
+                load_time_from,
+                route_from,
+                route_to,
+                args.gtp,
+            )
+        fact = fact_future.result()
+        report_rows("fact", fact)
+        for database, forecast_future in forecast_futures.items():
+            report_rows(f"forecast_{database}", forecast_future.result())
+        forecast_new = pd.concat(
+            [
+                forecast_future.result()
+                for forecast_future in forecast_futures.values()
+            ],
+            axis=0,
+        )
+    logging.info("Факт и прогнозы загружены из баз.")
+    report_stage("cache")
 
-# находим величину ошибки по модулю
-temp_dataframe["cblg"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_cblg"]
-)
-temp_dataframe["wpgq"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_wpgq"]
-)
-temp_dataframe["rp5_1da"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_rp5_1da"]
-)
-temp_dataframe["cbr_rp5"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_cbr_rp5"]
-)
-temp_dataframe["visualcrossing"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_visualcrossing"]
-)
-temp_dataframe["openmeteo"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_openmeteo"]
-)
-temp_dataframe["tomorrow_io"] = abs(
-    temp_dataframe["fact"] - temp_dataframe["value_tomorrow_io"]
-)
+    # Почасовые статистики: дни, которые больше не будут пересчитываться
+    # (раньше месяца, в который попадет окно следующего запуска),
+    # сразу сворачиваются по месяцам
+    month_from = (
+        pd.Timestamp(today) - pd.Timedelta(days=LOOKBACK_DAYS)
+    ).replace(day=1)
 
-logging.info("Датафрейм для расчета подготовлен.")
-temp_dataframe.to_excel("model_predicts_dataframe_X1.xlsx")
-r2_score_dataframe = pd.DataFrame()
-
-# Цикл расчета точности моделей по дням и по гтп
-logging.info("Старт. Расчет точности в цикле.")
-for date in temp_dataframe.date.value_counts().index:
-    model_accuracy_dataframe = temp_dataframe.loc[temp_dataframe.date == date]
-    for gtp in model_accuracy_dataframe.gtp.value_counts().index:
-        cblg_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_cblg"]
-        ]
-        cblg_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
+    # Раскладываем длинную таблицу по провайдерам, дописываем в кэш
+    # и (для pandas) читаем из кэша окно расчета
+    forecast_dataframes = {}
+    for provider, id_foreca in PROVIDERS.items():
+        forecast_provider = forecast_new.loc[
+            forecast_new["id_foreca"] == id_foreca,
+            ["gtp", "dt", "load_time", "value"],
         ]
-        cblg_r2 = r2_score(cblg_true, cblg_pred)
+        report_rows(f"forecast_{provider}_new", forecast_provider)
+        if PARTIAL:
+            # кэш только читается, новые строки добавляются в памяти
+            forecast_dataframe = forecast_merge(
+                [
+                    forecast_cache_read(FORECAST_CACHE, provider, load_from),
+                    forecast_provider,
+                ]
+            )
+            if dt_to is not None:
+                forecast_dataframe = forecast_dataframe[
+                    forecast_dataframe["dt"] < dt_to
+                ]
+            if args.gtp:
+                forecast_dataframe = forecast_dataframe[
+                    forecast_dataframe["gtp"].isin(args.gtp)
+                ]
+            forecast_dataframes[provider] = forecast_dataframe
+            continue
+        forecast_cache_write(FORECAST_CACHE, provider, forecast_provider)
+        forecast_cache_evict(
+            FORECAST_CACHE, provider, FORECAST_CACHE_MONTHS, load_from
+        )
+        if backend == "duckdb":
+            logging.info(f"{provider}: из баз {len(forecast_provider)} строк.")
+            continue
+        forecast_dataframe = forecast_cache_read(
+            FORECAST_CACHE, provider, load_from
+        )
+        report_rows(f"forecast_{provider}", forecast_dataframe)
+        logging.info(
+            f"{provider}: из баз {len(forecast_provider)} строк, для расчета"
+            f" {len(forecast_dataframe)} строк."
+        )
+        forecast_dataframes[provider] = forecast_dataframe
+    del forecast_new
+    logging.info("Прогнозы моделей загружены.")
 
-        wpgq_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_wpgq"]
-        ]
-        wpgq_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        wpgq_r2 = r2_score(wpgq_true, wpgq_pred)
+    if TENSOR_STORE and (backend == "duckdb" or PARTIAL):
+        logging.warning(
+            f"Тензорное хранилище {TENSOR_STORE} не обновляется: оно ведется"
+            " только полным и инкрементальным расчетом на pandas."
+        )
+    if backend == "duckdb":
+        # склейка, ансамбли, статистики и выгрузка почасовой таблицы в duckdb
+        logging.info("Старт. Расчет точности моделей в duckdb.")
+        report_stage("duckdb")
+        statistics, hour_statistics, coverage = duckdb_statistics(
+            fact, load_from, date_from, month_from
+        )
+    else:
+        # Склеиваем факт и прогнозы моделей, считаем среднее, максимум всех
+        # и ансамбль с весами, подобранными по каждой гтп
+        logging.info("Старт. Склейка датафрейма для расчета.")
+        report_stage("join")
+        temp_dataframe = model_predicts(fact, forecast_dataframes)
+        if TENSOR_STORE and not PARTIAL:
+            report_stage("tensor_store")
+            tensor_store_write(TENSOR_STORE, fact, forecast_dataframes)
+        report_stage("ensemble")
+        temp_dataframe["value_blend"] = ensemble_predict(
+            temp_dataframe,
+            [f"value_{provider}" for provider in PROVIDERS],
+            ENSEMBLE_DAYS,
+            VALUE_DTYPE,
+        )
+        # дни до date_from нужны были только для подбора весов ансамбля
+        temp_dataframe = temp_dataframe[
+            temp_dataframe["dt"] >= pd.Timestamp(date_from)
+        ].reset_index(drop=True)
 
-        rp5_1da_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_rp5_1da"]
-        ]
-        rp5_1da_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        rp5_1da_r2 = r2_score(rp5_1da_true, rp5_1da_pred)
+        temp_rows = report_rows("model_predicts", temp_dataframe)
+        logging.info(
+            "Датафрейм для расчета подготовлен:"
+            f" {temp_rows['rows']} строк, {temp_rows['bytes'] / 2**20:.0f} МБ."
+        )
 
-        cbr_rp5_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_cbr_rp5"]
-        ]
-        cbr_rp5_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        cbr_rp5_r2 = r2_score(cbr_rp5_true, cbr_rp5_pred)
+        # почасовая таблица выгружается в отдельном потоке параллельно
+        # с расчетом
+        output_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        model_predicts_future = output_executor.submit(
+            report_timed,
+            "output_model_predicts",
+            model_predicts_write,
+            temp_dataframe,
+        )
 
-        visualcrossing_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_visualcrossing"]
-        ]
-        visualcrossing_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        visualcrossing_r2 = r2_score(visualcrossing_true, visualcrossing_pred)
+        logging.info("Старт. Расчет точности моделей.")
+        report_stage("scoring")
+        # сегодняшний день не закончился и в статистики не попадает
+        finished = temp_dataframe[temp_dataframe["dt"] < pd.Timestamp(today)]
+        date = finished["dt"].dt.normalize()
+        # дни моделей с покрытием ниже COVERAGE_MIN не считаются ни в
+        # дневных, ни в почасовых статистиках
+        coverage = score_coverage(
+            finished,
+            MODELS,
+            {"gtp": finished["gtp"], "date": date},
+            COVERAGE_MIN,
+        )
+        coverage["date"] = coverage["date"].dt.strftime("%Y-%m-%d")
+        statistics = score_statistics_parallel(
+            finished,
+            MODELS,
+            {"gtp": finished["gtp"], "date": date},
+            SCORE_WORKERS,
+        )
+        statistics["date"] = statistics["date"].dt.strftime("%Y-%m-%d")
+        period = date.where(
+            date >= month_from, date.dt.to_period("M").dt.start_time
+        )
+        hour_statistics = score_statistics_parallel(
+            finished,
+            MODELS,
+            {
+                "gtp": finished["gtp"],
+                "period": period,
+                "hour": finished["dt"].dt.hour,
+            },
+            SCORE_WORKERS,
+        )
+        hour_statistics["period"] = hour_statistics["period"].dt.strftime(
+            "%Y-%m-%d"
+        )
+        del finished, date, period
 
-        openmeteo_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_openmeteo"]
-        ]
-        openmeteo_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        openmeteo_r2 = r2_score(openmeteo_true, openmeteo_pred)
+    # Покрытие дней гтп прогнозами моделей в окне расчета
+    run_report["coverage_skipped"] = int(coverage["skipped"].sum())
+    logging.info(
+        f"Пропущено дней гтп с покрытием ниже {COVERAGE_MIN}:"
+        f" {run_report['coverage_skipped']}."
+    )
+    output_write(coverage, "coverage")
 
-        tomorrow_io_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_tomorrow_io"]
-        ]
-        tomorrow_io_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        tomorrow_io_r2 = r2_score(tomorrow_io_true, tomorrow_io_pred)
+    # Сохраняем законченные дни в хранилище и собираем итоговые таблицы
+    # по всей истории из хранилища
+    if PARTIAL:
+        # частичный пересчет в хранилище не пишется, метрики - по окну
+        metrics = score_metrics(statistics, ["date", "gtp", "model"])
+        output_write(metrics, "metrics")
+        connection_store.close()
+    else:
+        report_stage("store_save")
+        score_store_save(connection_store, statistics, date_from)
+        hour_store_save(
+            connection_store, hour_statistics, date_from, month_from.date()
+        )
+        report_stage("rollups")
+        metrics = score_metrics(
+            score_store_load(connection_store), ["date", "gtp", "model"]
+        )
+        output_write(metrics, "metrics")
+        for name, rollup in score_rollups(connection_store).items():
+            output_write(rollup, name)
+        connection_store.close()
+        logging.info("Хранилище статистик обновлено.")
 
-        aver_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_aver"]
-        ]
-        aver_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        aver_r2 = r2_score(aver_true, aver_pred)
+    report_stage("summary")
+    r2_score_dataframe, r2_score_by_gtp = r2_summary(metrics)
+    output_write(r2_score_dataframe, "r2_score")
+    output_write(r2_score_by_gtp, "r2_score_by_gtp")
+    winners = r2_score_by_gtp.iloc[-1].drop("date").dropna().to_dict()
+    run_report["winners"] = winners
+    run_report["r2_drops"] = r2_drops(metrics, winners)
+    logging.info("Точность моделей посчитана.")
+    if backend == "pandas":
+        report_stage("output_wait")
+        model_predicts_future.result()
+        output_executor.shutdown()
+    report_stage()
+    run_report["status"] = "ok"
 
-        max_pred = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["value_max"]
-        ]
-        max_true = model_accuracy_dataframe.loc[
-            model_accuracy_dataframe.gtp == gtp, ["fact"]
-        ]
-        max_r2 = r2_score(max_true, max_pred)
 
-        data_row = {
-            "date": date,
-            "gtp": gtp,
-            "cblg": cblg_r2,
-            "wpgq": wpgq_r2,
-            "rp5_1da": rp5_1da_r2,
-            "cbr_rp5": cbr_rp5_r2,
-            "visualcrossing": visualcrossing_r2,
-            "openmeteo": openmeteo_r2,
-            "tomorrow_io": tomorrow_io_r2,
-            "aver_all": aver_r2,
-            "max_all": max_r2,
-        }
-        r2_score_dataframe = r2_score_dataframe.append(
-            data_row, ignore_index=True
+# Разбор точности по срезам времени загрузки (--vintages)
+# Хранилище статистик и кэш прогнозов (в нем один прогноз на час)
+# не используются: прогнозы всех времен загрузки в окне срезов грузятся
+# из баз за последние VINTAGE_DAYS законченных дней
+# (или за --date-from/--date-to), с фильтрами --gtp и --providers
+
+
+def vintages_run(args):
+    report_stage("vintages_load")
+    date_from = args.date_from or today - datetime.timedelta(
+        days=VINTAGE_DAYS
+    )
+    date_to = today
+    if args.date_to:
+        date_to = min(today, args.date_to + datetime.timedelta(days=1))
+    dt_from = datetime.datetime.combine(date_from, datetime.time())
+    dt_to = datetime.datetime.combine(date_to, datetime.time())
+    offsets = [vintage_offset(cutoff) for cutoff in VINTAGE_CUTOFFS]
+    # окно load_time от начала суток dt: от самого раннего среза минус
+    # VINTAGE_MAX_AGE часов до самого позднего среза
+    load_minutes = (
+        (min(offsets) - int(VINTAGE_MAX_AGE * 3600)) // 60,
+        -(-max(offsets) // 60),
+    )
+    logging.info(
+        f"Срезы загрузки {VINTAGE_CUTOFFS} с {date_from} по {date_to}."
+    )
+    load_time_from = {provider: None for provider in PROVIDERS}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=LOAD_WORKERS
+    ) as executor:
+        fact_future = executor.submit(
+            report_timed,
+            "load_fact",
+            fact_load,
+            0,
+            dt_from,
+            dt_to,
+            args.gtp,
+        )
+        forecast_futures = {}
+        for database, route_from, route_to in forecast_routes(
+            load_time_from, date_from, dt_to
+        ):
+            forecast_futures[database] = executor.submit(
+                report_timed,
+                f"load_{database}",
+                forecast_load_database,
+                database,
+                load_time_from,
+                route_from,
+                route_to,
+                args.gtp,
+                load_minutes,
+            )
+        fact = fact_future.result()
+        report_rows("fact", fact)
+        forecast_new = pd.concat(
+            [
+                forecast_future.result()
+                for forecast_future in forecast_futures.values()
+            ],
+            axis=0,
+            ignore_index=True,
         )
+    # дни на границе архива и основной базы приходят из обеих
+    forecast_new.drop_duplicates(
+        subset=["id_foreca", "gtp", "dt", "load_time"],
+        keep="last",
+        inplace=True,
+    )
+    report_rows("forecast_vintages", forecast_new)
 
+    report_stage("vintages")
+    forecast_dataframes = {
+        provider: forecast_new.loc[
+            forecast_new["id_foreca"] == id_foreca,
+            ["gtp", "dt", "load_time", "value"],
+        ]
+        for provider, id_foreca in PROVIDERS.items()
+    }
+    del forecast_new
+    metrics = vintage_metrics(
+        fact, forecast_dataframes, VINTAGE_CUTOFFS, VINTAGE_MAX_AGE
+    )
+    output_write(metrics, "vintages")
+    logging.info("Точность по срезам загрузки посчитана.")
+    report_stage()
 
-# Добавляем столбик с названием самой точной модели
-model = r2_score_dataframe.drop(["gtp", "date"], axis="columns").idxmax(axis=1)
-r2_score_dataframe["model"] = model
-r2_score_dataframe["date"] = r2_score_dataframe["date"].astype(
-    "datetime64[ns]"
-)
-r2_score_dataframe["gtp"] = r2_score_dataframe["gtp"].astype("str")
-r2_score_dataframe.sort_values(["gtp", "date"], inplace=True)
-r2_score_dataframe.reset_index(drop=True, inplace=True)
-r2_score_dataframe.to_excel("r2_score_dataframe_X1.xlsx")
-r2_score_dataframe.drop(
-    [
-        "cblg",
-        "wpgq",
-        "rp5_1da",
-        "cbr_rp5",
-        "visualcrossing",
-        "openmeteo",
-        "tomorrow_io",
-        "aver_all",
-        "max_all",
-    ],
-    axis="columns",
-    inplace=True,
-)
-r2_score_dataframe = pd.pivot_table(
-    r2_score_dataframe,
-    values="model",
-    index=["date"],
-    columns=["gtp"],
-    aggfunc=np.sum,
-)
-r2_score_dataframe.reset_index(inplace=True)
-r2_score_dataframe.reset_index(drop=True, inplace=True)
-
-# удаление пустой последней строки с сегодняшней датой, т.к. день не закончился
-r2_score_dataframe.drop(r2_score_dataframe.tail(1).index, inplace=True)
-
-most_accurate_model_dict = {"date": "most_accurate_model"}
-for col in range(1, r2_score_dataframe.shape[1]):
-    print(col)
-    print(r2_score_dataframe.iloc[:, col].mode()[0])
-    most_accurate_model_dict[
-        r2_score_dataframe.iloc[:, col].name
-    ] = r2_score_dataframe.iloc[:, col].mode()[0]
-
-r2_score_dataframe = r2_score_dataframe.append(
-    most_accurate_model_dict, ignore_index=True
-)
-r2_score_dataframe.to_excel("r2_score_dataframe_by_gtp_X1.xlsx")
-logging.info("Точность моделей посчитана.")
-
-# Замер времени выполнения конец
-end_time = datetime.datetime.now()
-delta = end_time - start_time
-print(end_time)
-print(delta)
+
+# Точка входа: ключи запуска (argv, по умолчанию из командной строки),
+# настройка модуля, затем бенчмарки или расчет точности
+
+
+def main(argv=None):
+    # предупреждения pandas и numpy не засоряют лог планировщика
+    # (при импорте модуля фильтры процесса не меняются)
+    warnings.filterwarnings("ignore")
+    args = arguments(argv)
+    configure(args)
+    if args.benchmark_join or args.benchmark:
+        for gtp_count in args.benchmark_gtp:
+            for days_count in args.benchmark_days:
+                if args.benchmark_join:
+                    join_benchmark(gtp_count, days_count)
+                if args.benchmark:
+                    pipeline_benchmark(
+                        gtp_count,
+                        days_count,
+                        args.benchmark_missing,
+                        args.benchmark_repeats,
+                        args.benchmark_report,
+                    )
+        return
+    if args.watch:
+        watch(args)
+        return
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import model_accuracy_large_interval_WE_X1_git as accuracy  # noqa: E402
+
+
+# Настройка модуля для теста: пустые разделы баз, хранилища и кэш
+# во временном каталоге, accuracy_settings - раздел model_accuracy
+# поверх них
+
+
+@pytest.fixture
+def configured(tmp_path):
+    def configure(argv=(), telegram=(), **accuracy_settings):
+        accuracy.configure(
+            accuracy.arguments(list(argv)),
+            {
+                "telegram": list(telegram),
+                "sql_db": [],
+                "pyodbc_db": [],
+                "postgresql_db": [],
+                "model_accuracy": {
+                    "score_store": str(tmp_path / "score_store.sqlite"),
+                    "forecast_cache": str(tmp_path / "forecast_cache"),
+                    "duckdb_temp": str(tmp_path / "duckdb_temp"),
+                    "run_report": str(tmp_path / "run.json"),
+                    "telegram_digest": False,
+                    **accuracy_settings,
+                },
+            },
+        )
+        return accuracy
+
+    return configure
@@ -0,0 +1,155 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("duckdb")
+
+LOAD_FROM = datetime.date(2024, 1, 1)
+DATE_FROM = datetime.date(2024, 1, 11)
+MONTH_FROM = pd.Timestamp("2024-02-01")
+DAYS = 40
+
+
+# Синтетические факт и прогнозы всех провайдеров: у каждого провайдера
+# пропущена часть часов, у одного - целые дни (покрытие ниже порога),
+# у факта - несколько часов без значения
+
+
+def synthetic(accuracy):
+    rng = np.random.default_rng(0)
+    dt = pd.date_range(LOAD_FROM, periods=DAYS * 24, freq="h")
+    gtp_names = ["GVIE0001", "GVIE0002", "GVIE0003"]
+    fact = pd.DataFrame(
+        {
+            "gtp": pd.Categorical(np.repeat(gtp_names, len(dt))),
+            "dt": np.tile(dt, len(gtp_names)),
+            "fact": rng.uniform(0, 30, len(dt) * len(gtp_names)),
+        }
+    )
+    fact.loc[rng.choice(len(fact), 5, replace=False), "fact"] = np.nan
+    forecast_dataframes = {}
+    for number, provider in enumerate(accuracy.PROVIDERS):
+        forecast = fact[["gtp", "dt"]].assign(
+            load_time=fact["dt"].dt.normalize() - pd.Timedelta(hours=14),
+            value=fact["fact"].fillna(10) * (1 + number / 20)
+            + rng.normal(0, 1 + number, len(fact)),
+        )
+        keep = rng.random(len(forecast)) > 0.05
+        if number == 1:
+            keep &= forecast["dt"].dt.day % 7 != 0
+        forecast_dataframes[provider] = forecast[keep]
+    return accuracy.fact_prepare(fact), forecast_dataframes
+
+
+# Тот же расчет, что run_stages на pandas
+
+
+def pandas_statistics(accuracy, fact, forecast_dataframes):
+    predicts = accuracy.model_predicts(fact, forecast_dataframes)
+    predicts["value_blend"] = accuracy.ensemble_predict(
+        predicts,
+        [f"value_{provider}" for provider in accuracy.PROVIDERS],
+        accuracy.ENSEMBLE_DAYS,
+    )
+    finished = predicts[
+        predicts["dt"] >= pd.Timestamp(DATE_FROM)
+    ].reset_index(drop=True)
+    date = finished["dt"].dt.normalize()
+    coverage = accuracy.score_coverage(
+        finished,
+        accuracy.MODELS,
+        {"gtp": finished["gtp"], "date": date},
+        accuracy.COVERAGE_MIN,
+    )
+    coverage["date"] = coverage["date"].dt.strftime("%Y-%m-%d")
+    statistics = accuracy.score_statistics(
+        finished, accuracy.MODELS, {"gtp": finished["gtp"], "date": date}
+    )
+    statistics["date"] = statistics["date"].dt.strftime("%Y-%m-%d")
+    period = date.where(
+        date >= MONTH_FROM, date.dt.to_period("M").dt.start_time
+    )
+    hour_statistics = accuracy.score_statistics(
+        finished,
+        accuracy.MODELS,
+        {
+            "gtp": finished["gtp"],
+            "period": period,
+            "hour": finished["dt"].dt.hour,
+        },
+    )
+    hour_statistics["period"] = hour_statistics["period"].dt.strftime(
+        "%Y-%m-%d"
+    )
+    return statistics, hour_statistics, coverage
+
+
+def assert_same(pandas_frame, duckdb_frame, keys, columns):
+    pandas_frame = pandas_frame.assign(gtp=pandas_frame["gtp"].astype(str))
+    duckdb_frame = duckdb_frame.assign(gtp=duckdb_frame["gtp"].astype(str))
+    merged = pandas_frame.merge(
+        duckdb_frame,
+        on=keys,
+        how="outer",
+        suffixes=("", "_duckdb"),
+        indicator=True,
+    )
+    assert (merged["_merge"] == "both").all()
+    for column in columns:
+        np.testing.assert_allclose(
+            merged[f"{column}_duckdb"].to_numpy(dtype="float64"),
+            merged[column].to_numpy(dtype="float64"),
+            rtol=1e-9,
+            atol=1e-9,
+            err_msg=column,
+        )
+
+
+def test_duckdb_matches_pandas(configured):
+    accuracy = configured(backend="duckdb", coverage_min=0.9)
+    fact, forecast_dataframes = synthetic(accuracy)
+    for provider, forecast_dataframe in forecast_dataframes.items():
+        accuracy.forecast_cache_write(
+            accuracy.FORECAST_CACHE, provider, forecast_dataframe
+        )
+    cached = {
+        provider: accuracy.forecast_cache_read(
+            accuracy.FORECAST_CACHE, provider, LOAD_FROM
+        )
+        for provider in accuracy.PROVIDERS
+    }
+    statistics, hour_statistics, coverage = pandas_statistics(
+        accuracy, fact, cached
+    )
+    duckdb_statistics, duckdb_hour, duckdb_coverage = (
+        accuracy.duckdb_statistics(fact, LOAD_FROM, DATE_FROM, MONTH_FROM)
+    )
+    assert coverage["skipped"].any()
+
+    assert_same(
+        statistics,
+        duckdb_statistics,
+        ["date", "gtp", "model"],
+        accuracy.STATISTICS,
+    )
+    assert_same(
+        hour_statistics,
+        duckdb_hour,
+        ["period", "gtp", "model", "hour"],
+        accuracy.STATISTICS,
+    )
+    assert_same(
+        coverage,
+        duckdb_coverage,
+        ["date", "gtp", "model"],
+        ["hours", "valid_hours", "coverage", "skipped"],
+    )
+    keys = ["date", "gtp", "model"]
+    assert_same(
+        accuracy.score_metrics(statistics, keys),
+        accuracy.score_metrics(duckdb_statistics, keys),
+        keys,
+        ["r2", "mae", "rmse", "bias", "nmae"],
+    )
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ["value_a", "value_b", "value_c"]
+
+
+def predicts_frame():
+    rng = np.random.default_rng(0)
+    dt = pd.date_range("2024-01-01", periods=20 * 24, freq="h")
+    frames = []
+    for gtp in ["GVIE0001", "GVIE0002", "GVIE0003"]:
+        fact = rng.uniform(0, 30, len(dt))
+        frame = pd.DataFrame({"gtp": gtp, "dt": dt, "fact": fact})
+        for number, column in enumerate(COLUMNS):
+            frame[column] = fact * (1 + number / 10) + rng.normal(
+                0, 1 + number, len(dt)
+            )
+        frames.append(frame)
+    predicts = pd.concat(frames, ignore_index=True)
+    # пропуски провайдера и час без прогнозов
+    predicts.loc[rng.random(len(predicts)) < 0.1, "value_b"] = np.nan
+    predicts.loc[5, COLUMNS] = np.nan
+    return predicts
+
+
+# Час без факта не входит в подбор весов: прогноз ансамбля остальных
+# часов совпадает с расчетом без этих часов, на сам час прогноз есть
+
+
+def test_fact_nan_left_out_of_fit(configured):
+    accuracy = configured()
+    predicts = predicts_frame()
+    fact_nan = predicts.groupby("gtp").sample(1, random_state=1).index
+    predicts.loc[fact_nan, "fact"] = np.nan
+
+    blend = accuracy.ensemble_predict(predicts, COLUMNS, 7)
+    assert blend.isna().sum() == 1
+    assert np.isnan(blend[5])
+    assert blend[fact_nan].notna().all()
+
+    kept = predicts.drop(index=fact_nan)
+    np.testing.assert_allclose(
+        blend[kept.index].to_numpy(),
+        accuracy.ensemble_predict(kept, COLUMNS, 7).to_numpy(),
+        rtol=1e-12,
+        equal_nan=True,
+    )
+
+
+def test_missing_provider_hours_use_mean(configured):
+    accuracy = configured()
+    predicts = predicts_frame()
+    blend = accuracy.ensemble_predict(predicts, COLUMNS, 7)
+    # первый день без истории: веса равные, прогноз - среднее
+    # провайдеров, у которых прогноз есть
+    first_day = (predicts["dt"] < "2024-01-02") & (predicts.index != 5)
+    np.testing.assert_allclose(
+        blend[first_day].to_numpy(),
+        predicts.loc[first_day, COLUMNS].mean(axis=1).to_numpy(),
+        rtol=1e-12,
+    )
@@ -0,0 +1,104 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+MODELS = {"a": "value_a", "b": "value_b"}
+
+
+def predicts_frame(days):
+    rng = np.random.default_rng(0)
+    dt = pd.date_range("2024-02-01", periods=days * 24, freq="h")
+    frames = []
+    for gtp in ["GVIE0001", "GVIE0002"]:
+        fact = rng.uniform(0, 30, len(dt))
+        frames.append(
+            pd.DataFrame(
+                {
+                    "gtp": gtp,
+                    "dt": dt,
+                    "fact": fact,
+                    "value_a": fact + rng.normal(0, 3, len(dt)),
+                    "value_b": fact + rng.normal(1, 5, len(dt)),
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+# Почасовые статистики окна с date_from, как в run_stages: дни раньше
+# month_from сразу сворачиваются по месяцам
+
+
+def hour_statistics(accuracy, predicts, date_from, month_from):
+    window = predicts[predicts["dt"] >= pd.Timestamp(date_from)]
+    date = window["dt"].dt.normalize()
+    period = date.where(
+        date >= pd.Timestamp(month_from),
+        date.dt.to_period("M").dt.start_time,
+    )
+    statistics = accuracy.score_statistics(
+        window,
+        MODELS,
+        {"gtp": window["gtp"], "period": period, "hour": window["dt"].dt.hour},
+    )
+    statistics["period"] = statistics["period"].dt.strftime("%Y-%m-%d")
+    return statistics
+
+
+def test_window_inside_folded_month(configured, tmp_path):
+    accuracy = configured()
+    month_from = datetime.date(2024, 3, 1)
+    connection_store = accuracy.score_store_connect(
+        str(tmp_path / "store.sqlite")
+    )
+
+    # первый запуск: 1 февраля - 3 марта, февраль свернут по месяцу
+    predicts = predicts_frame(32)
+    date_from = datetime.date(2024, 2, 1)
+    accuracy.hour_store_save(
+        connection_store,
+        hour_statistics(accuracy, predicts, date_from, month_from),
+        date_from,
+        month_from,
+    )
+
+    # второй запуск отстал на день: окно начинается 29 февраля
+    predicts = predicts_frame(33)
+    date_from = datetime.date(2024, 2, 29)
+    with pytest.raises(ValueError):
+        accuracy.hour_store_save(
+            connection_store,
+            hour_statistics(accuracy, predicts, date_from, month_from),
+            date_from,
+            month_from,
+        )
+    date_from = accuracy.hour_store_date_from(connection_store, date_from)
+    assert date_from == datetime.date(2024, 2, 1)
+    accuracy.hour_store_save(
+        connection_store,
+        hour_statistics(accuracy, predicts, date_from, month_from),
+        date_from,
+        month_from,
+    )
+
+    keys = ["gtp", "model", "hour"]
+    stored = accuracy.statistics_combine(
+        accuracy.hour_store_load(connection_store), keys
+    )
+    expected = accuracy.score_statistics(
+        predicts,
+        MODELS,
+        {"gtp": predicts["gtp"], "hour": predicts["dt"].dt.hour},
+    )
+    merged = expected.merge(stored, on=keys, suffixes=("", "_stored"))
+    assert len(merged) == len(expected) == 2 * len(MODELS) * 24
+    for column in accuracy.STATISTICS:
+        np.testing.assert_allclose(
+            merged[f"{column}_stored"].to_numpy(dtype="float64"),
+            merged[column].to_numpy(dtype="float64"),
+            rtol=1e-9,
+        )
+    connection_store.close()
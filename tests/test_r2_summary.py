@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+import model_accuracy_large_interval_WE_X1_git as accuracy
+
+
+# Метрики: у GVIE0002 за 2024-01-02 r2 нет ни у одной модели (гтп
+# начала выработку в 23:00, меньше двух часов), у GVIE0003 r2 нет вовсе
+
+
+def metrics_frame():
+    rows = []
+    for date in ["2024-01-01", "2024-01-02"]:
+        for gtp in ["GVIE0001", "GVIE0002", "GVIE0003"]:
+            for number, model in enumerate(accuracy.MODELS):
+                r2 = 0.5 + number / 100
+                if gtp == "GVIE0003" or (
+                    gtp == "GVIE0002" and date == "2024-01-02"
+                ):
+                    r2 = np.nan
+                rows.append(
+                    {"date": date, "gtp": gtp, "model": model, "r2": r2}
+                )
+    return pd.DataFrame(rows)
+
+
+def test_r2_summary_day_without_r2():
+    r2_score_dataframe, r2_score_by_gtp = accuracy.r2_summary(
+        metrics_frame()
+    )
+    model = r2_score_dataframe.set_index(["gtp", "date"])["model"]
+    best = list(accuracy.MODELS)[-1]
+    assert model[("GVIE0001", pd.Timestamp("2024-01-02"))] == best
+    assert model[("GVIE0002", pd.Timestamp("2024-01-01"))] == best
+    assert pd.isna(model[("GVIE0002", pd.Timestamp("2024-01-02"))])
+    assert model.xs("GVIE0003").isna().all()
+
+    most_accurate = r2_score_by_gtp.iloc[-1]
+    assert most_accurate["date"] == "most_accurate_model"
+    assert most_accurate["GVIE0002"] == best
+    assert pd.isna(most_accurate["GVIE0003"])
+
+
+def test_r2_summary_without_any_r2():
+    metrics = metrics_frame().assign(r2=np.nan)
+    r2_score_dataframe, r2_score_by_gtp = accuracy.r2_summary(metrics)
+    assert r2_score_dataframe["model"].isna().all()
+    assert r2_score_by_gtp.iloc[-1].drop("date").isna().all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+sklearn_metrics = pytest.importorskip("sklearn.metrics")
+
+
+# Почасовая таблица двух гтп: обычные дни, день нулевой выработки
+# (одна модель прогнозирует точно 0), день постоянного факта и день
+# из одного часа
+
+
+def predicts_frame():
+    rng = np.random.default_rng(0)
+    frames = []
+    for gtp in ["GVIE0001", "GVIE0002"]:
+        for day, hours in [
+            ("2024-01-01", 24),
+            ("2024-01-02", 24),
+            ("2024-01-03", 24),
+            ("2024-01-04", 24),
+            ("2024-01-05", 1),
+        ]:
+            dt = pd.date_range(day, periods=hours, freq="h")
+            fact = rng.uniform(0, 30, hours)
+            if day == "2024-01-02":
+                fact = np.zeros(hours)
+            if day == "2024-01-03":
+                fact = np.full(hours, 7.5)
+            frame = pd.DataFrame({"gtp": gtp, "dt": dt, "fact": fact})
+            frame["value_a"] = fact + rng.normal(0, 3, hours)
+            frame["value_b"] = np.zeros(hours)
+            frame["value_c"] = fact.copy()
+            frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_r2_matches_sklearn(configured):
+    accuracy = configured()
+    predicts = predicts_frame()
+    models = {"a": "value_a", "b": "value_b", "c": "value_c"}
+    date = predicts["dt"].dt.normalize()
+    metrics = accuracy.score_metrics(
+        accuracy.score_statistics(
+            predicts, models, {"gtp": predicts["gtp"], "date": date}
+        ),
+        ["gtp", "date", "model"],
+    )
+    assert len(metrics) == 2 * 5 * len(models)
+    for row in metrics.itertuples():
+        group = predicts[(predicts["gtp"] == row.gtp) & (date == row.date)]
+        y_true = group["fact"].to_numpy()
+        y_pred = group[models[row.model]].to_numpy()
+        if len(group) < 2:
+            assert np.isnan(row.r2)
+            continue
+        expected = sklearn_metrics.r2_score(y_true, y_pred)
+        assert row.r2 == pytest.approx(expected, abs=1e-12)
+        assert row.mae == pytest.approx(
+            sklearn_metrics.mean_absolute_error(y_true, y_pred), abs=1e-12
+        )
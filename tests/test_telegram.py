@@ -0,0 +1,87 @@
+import http.server
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+
+# Локальная замена api telegram: запоминает (путь, chat_id, text)
+# каждого sendMessage и отвечает через delay секунд
+
+
+@pytest.fixture
+def telegram_api():
+    received = []
+    settings = {"delay": 0.0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            data = urllib.parse.parse_qs(body.decode())
+            time.sleep(settings["delay"])
+            received.append((self.path, data["chat_id"][0], data["text"][0]))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'{"ok": true}')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", received, settings
+    server.shutdown()
+    server.server_close()
+
+
+CHANNELS = [
+    {"bot_token": "bot1", "channel_id": 101},
+    {"bot_token": "bot2", "channel_id": 102},
+]
+
+
+def configure_telegram(configured, api, timeout=10):
+    accuracy = configured(
+        telegram=CHANNELS,
+        telegram_api=api,
+        telegram_digest=True,
+        telegram_flush_timeout=timeout,
+    )
+    accuracy.report_start(accuracy.arguments([]))
+    accuracy.run_report["status"] = "ok"
+    return accuracy
+
+
+def test_digest_sent_to_every_channel(configured, telegram_api):
+    api, received, _ = telegram_api
+    accuracy = configure_telegram(configured, api)
+    accuracy.report_write()
+    assert sorted((path, chat_id) for path, chat_id, _ in received) == [
+        ("/botbot1/sendMessage", "101"),
+        ("/botbot2/sendMessage", "102"),
+    ]
+    for _, _, text in received:
+        assert text.startswith("Точность моделей X1: ok")
+
+
+def test_worker_survives_send_error(configured, telegram_api):
+    api, received, _ = telegram_api
+    accuracy = configure_telegram(configured, api)
+    # канала с таким номером нет: ошибка не из requests
+    accuracy.telegram(len(CHANNELS), "lost")
+    accuracy.telegram(0, "delivered")
+    accuracy.telegram_flush(10)
+    assert [text for *_, text in received] == ["delivered"]
+
+
+def test_hanging_api_does_not_block(configured, telegram_api):
+    api, received, settings = telegram_api
+    settings["delay"] = 5.0
+    accuracy = configure_telegram(configured, api, timeout=0.5)
+    start = time.perf_counter()
+    accuracy.report_write()
+    assert time.perf_counter() - start < 2.0
+    assert received == []
@@ -0,0 +1,150 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+GTP = ["GVIE0001", "GVIE0002", "GVIE0003"]
+ENSEMBLE_DAYS = 5
+
+
+# Источники watch без баз: факт по часам за ENSEMBLE_DAYS дней до
+# сегодня и за сегодня, последний DT факта сдвигается на каждой
+# проверке. Прогнозы на сегодня приходят в двух версиях (load_time),
+# версии перемешаны
+
+
+def stub_sources(accuracy, watermarks):
+    rng = np.random.default_rng(0)
+    today = pd.Timestamp(datetime.date.today())
+    hours = pd.date_range(
+        today - pd.Timedelta(days=ENSEMBLE_DAYS),
+        today + pd.Timedelta(days=1),
+        freq="h",
+        inclusive="left",
+    )
+    fact = pd.DataFrame(
+        {"gtp": np.repeat(GTP, len(hours)), "dt": np.tile(hours, len(GTP))}
+    )
+    fact["fact"] = rng.uniform(0, 30, len(fact))
+    forecasts = []
+    for id_foreca in accuracy.PROVIDERS.values():
+        forecast = fact[["gtp", "dt"]].assign(
+            load_time=fact["dt"].dt.normalize() - pd.Timedelta(hours=14),
+            id_foreca=id_foreca,
+            value=fact["fact"] + rng.normal(0, 3, len(fact)),
+        )
+        forecasts.append(forecast.sample(frac=0.9, random_state=id_foreca))
+    forecasts = pd.concat(forecasts, ignore_index=True)
+    today_rows = forecasts[forecasts["dt"] >= today]
+    forecasts = pd.concat(
+        [
+            forecasts,
+            today_rows.assign(
+                load_time=today_rows["load_time"] - pd.Timedelta(hours=6),
+                value=rng.uniform(100, 200, len(today_rows)),
+            ),
+        ],
+        ignore_index=True,
+    ).sample(frac=1, random_state=0, ignore_index=True)
+
+    def fact_source(dt_from, dt_to):
+        rows = fact[(fact["dt"] >= dt_from) & (fact["dt"] < dt_to)]
+        return accuracy.fact_prepare(
+            rows.astype(
+                {"gtp": "category", "fact": accuracy.VALUE_DTYPE}
+            ).reset_index(drop=True)
+        )
+
+    def fact_watermark(dt_from):
+        return next(watermarks)
+
+    def forecast_today(day):
+        rows = forecasts[forecasts["dt"].dt.date == day]
+        return rows.astype({"gtp": "category"}).reset_index(drop=True)
+
+    def forecast_history(date_from):
+        rows = forecasts[
+            (forecasts["dt"] >= pd.Timestamp(date_from))
+            & (forecasts["dt"] < today)
+        ]
+        return {
+            provider: accuracy.forecast_types(
+                rows.loc[
+                    rows["id_foreca"] == id_foreca,
+                    ["gtp", "dt", "load_time", "value"],
+                ]
+            )
+            for provider, id_foreca in accuracy.PROVIDERS.items()
+        }
+
+    sources = {
+        "fact": fact_source,
+        "fact_watermark": fact_watermark,
+        "forecast_today": forecast_today,
+        "forecast_history": forecast_history,
+    }
+    return sources, forecasts
+
+
+# Метрики, накопленные за несколько проверок, совпадают с разовым
+# расчетом по тем же часам с последними версиями прогнозов
+
+
+def test_watch_matches_one_shot(configured):
+    accuracy = configured(
+        ensemble_days=ENSEMBLE_DAYS, watch_port=0, watch_interval=0
+    )
+    today = pd.Timestamp(datetime.date.today())
+    watermarks = iter(
+        [
+            today + pd.Timedelta(minutes=10),
+            today + pd.Timedelta(hours=3, minutes=5),
+            today + pd.Timedelta(hours=3, minutes=40),
+            today + pd.Timedelta(hours=9),
+        ]
+    )
+    sources, forecasts = stub_sources(accuracy, watermarks)
+    state = accuracy.watch(accuracy.arguments([]), sources, polls=4)
+    assert state["closed_to"] == today + pd.Timedelta(hours=9)
+
+    latest = forecasts.sort_values("load_time").drop_duplicates(
+        ["id_foreca", "gtp", "dt"], keep="last"
+    )
+    predicts = accuracy.model_predicts(
+        sources["fact"](
+            (today - pd.Timedelta(days=ENSEMBLE_DAYS)).to_pydatetime(),
+            state["closed_to"].to_pydatetime(),
+        ),
+        {
+            provider: accuracy.forecast_types(
+                latest.loc[
+                    latest["id_foreca"] == id_foreca,
+                    ["gtp", "dt", "load_time", "value"],
+                ]
+            )
+            for provider, id_foreca in accuracy.PROVIDERS.items()
+        },
+    )
+    predicts["value_blend"] = accuracy.ensemble_predict(
+        predicts,
+        [f"value_{provider}" for provider in accuracy.PROVIDERS],
+        ENSEMBLE_DAYS,
+        accuracy.VALUE_DTYPE,
+    ).to_numpy()
+    predicts = predicts[predicts["dt"] >= today]
+    statistics = accuracy.score_statistics(
+        predicts, accuracy.MODELS, {"gtp": predicts["gtp"]}
+    )
+    expected = accuracy.score_metrics(statistics, ["gtp", "model"]).assign(
+        hours=statistics["n"].to_numpy()
+    )
+
+    metrics = state["metrics"]
+    assert metrics["hours"].max() == 9
+    merged = expected.merge(metrics, on=["gtp", "model"], suffixes=("", "_"))
+    assert len(merged) == len(expected) == len(GTP) * len(accuracy.MODELS)
+    for column in ["hours", "r2", "mae", "rmse", "bias", "nmae"]:
+        np.testing.assert_allclose(
+            merged[f"{column}_"], merged[column], rtol=1e-9, equal_nan=True
+        )